@@ -0,0 +1,118 @@
+from json import dumps, loads
+from time import time
+from zlib import compress, decompress
+
+from loguru import logger
+
+from config import API_CACHE_CONFIG
+from database import db_lock, get_db
+from metrics import metrics
+from rate_limiter import rate_limited
+
+_initialized = False
+
+
+def init_api_cache():
+    global _initialized
+    with db_lock:
+        if _initialized:
+            return
+
+        get_db().execute(
+            """
+            create table if not exists api_cache (
+                cache_key text primary key,
+                body blob,
+                size integer,
+                expires_at real,
+                last_used real
+            )
+            """
+        )
+        get_db().execute('create index if not exists api_cache_eviction on api_cache (last_used)')
+        get_db().commit()
+        _initialized = True
+
+
+def _cache_key(endpoint, args, kwargs):
+    return f'{endpoint}:{dumps([args, kwargs], sort_keys=True, default=str)}'
+
+
+def _lookup(cache_key, now):
+    with db_lock:
+        row = get_db().execute(
+            'select body from api_cache where cache_key = ? and (expires_at is null or expires_at > ?)', (cache_key, now)
+        ).fetchone()
+        if row is None:
+            return None
+
+        with get_db():
+            get_db().execute('update api_cache set last_used = ? where cache_key = ?', (now, cache_key))
+
+    from pixivpy3.utils import JsonDict
+
+    return loads(decompress(row[0]), object_hook=JsonDict)
+
+
+def _evict():
+    """Drop expired entries, then the least recently used ones until the cache fits ``MAX_MB`` again."""
+    budget = API_CACHE_CONFIG['MAX_MB'] * 1024 ** 2
+    db = get_db()
+    db.execute('delete from api_cache where expires_at <= ?', (time(),))
+    (total,) = db.execute('select coalesce(sum(size), 0) from api_cache').fetchone()
+    if total <= budget:
+        return
+
+    evicted = []
+    # Permanent entries go last, they cost an API call each to get back.
+    for cache_key, size in db.execute(
+            'select cache_key, size from api_cache order by expires_at is null, last_used'):
+        evicted.append((cache_key,))
+        total -= size
+        if total <= budget:
+            break
+
+    db.executemany('delete from api_cache where cache_key = ?', evicted)
+    metrics.add('api_cache_evictions', len(evicted))
+    logger.debug(f'Evicted {len(evicted)} cached API responses.')
+
+
+def _store(cache_key, result, ttl, now):
+    body = compress(dumps(result, separators=(',', ':')).encode())
+    with db_lock, get_db():
+        get_db().execute(
+            'insert or replace into api_cache values (?, ?, ?, ?, ?)',
+            (cache_key, body, len(body), None if ttl is None else now + ttl, now)
+        )
+        _evict()
+
+
+def cached_call(fn, *args, **kwargs):
+    """
+    ``rate_limited(fn, ...)``, answered from the on-disk cache when the same call was made recently.
+
+    How long a response is reused is set per endpoint (the method name) in
+    ``API_CACHE_CONFIG['TTL']``; None keeps it for good, which suits immutable data like
+    ugoira frame lists. Endpoints not listed always go to the API.
+    """
+    endpoint = fn.__name__
+    ttls = API_CACHE_CONFIG['TTL']
+    if not API_CACHE_CONFIG['ENABLED'] or endpoint not in ttls:
+        return rate_limited(fn, *args, **kwargs)
+
+    init_api_cache()
+    now = time()
+    cache_key = _cache_key(endpoint, args, kwargs)
+    with metrics.timer('api_cache'):
+        result = _lookup(cache_key, now)
+
+    if result is not None:
+        metrics.add('api_cache_hits')
+        return result
+
+    metrics.add('api_cache_misses')
+    result = rate_limited(fn, *args, **kwargs)
+    with metrics.timer('api_cache'):
+        _store(cache_key, result, ttls[endpoint], now)
+
+    return result
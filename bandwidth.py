@@ -0,0 +1,203 @@
+from collections import Counter
+from datetime import datetime
+from os import getpid
+from socket import gethostname
+from threading import Condition
+from time import monotonic, time
+
+from config import BANDWIDTH_CONFIG
+from database import db_lock, get_db
+from metrics import metrics
+
+# Longest pause between two looks at the shared budget.
+POLL_INTERVAL = 0.1
+# A waiting process refreshes its claim every half of this; older claims belong to a process that is gone.
+WAITER_TTL = 1.0
+# Seconds worth of bytes drawn from the shared budget at once, then spent without touching the database.
+LEASE_SECONDS = 0.25
+
+_initialized = False
+
+
+def init_bandwidth_budget(capacity):
+    global _initialized
+    with db_lock:
+        if _initialized:
+            return
+
+        get_db().execute(
+            """
+            create table if not exists bandwidth_budget (
+                id integer primary key check (id = 0),
+                tokens real,
+                refilled_at real
+            )
+            """
+        )
+        get_db().execute(
+            """
+            create table if not exists bandwidth_waiters (
+                process varchar(100),
+                rank integer,
+                seen_at real,
+                primary key (process, rank)
+            )
+            """
+        )
+        get_db().execute('insert or ignore into bandwidth_budget values (0, ?, ?)', (capacity, time()))
+        get_db().commit()
+        _initialized = True
+
+
+class BandwidthBudget:
+    """
+    Token bucket over bytes, kept in the database so every downloader process draws from the same one.
+
+    The bookmark, by and fanbox scripts and each queue worker are separate processes, so the
+    bucket row and the classes still waiting for bytes live in SQLite. Each process leases
+    ``LEASE_SECONDS`` worth of bytes at a time and spends them locally. A lease waits while a
+    more urgent class is waiting, in this process or in another one, so a bookmark sync gets
+    the link first and a fanbox zip only uses what is left. A chunk may take the balance into
+    debt, chunks grow with the read buffer and waiting for a full one would stall the transfer.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.lease_size = max(int(rate * LEASE_SECONDS), 1)
+        self.process = f'{gethostname()}:{getpid()}'
+        self._changed = Condition()
+        self._waiting = Counter()
+        self._leased = 0
+        # Rank -> when this process last refreshed its waiter row.
+        self._announced = {}
+
+    def _lease(self, rank):
+        """Draw a lease from the shared bucket into the local balance, or return how long to wait before trying again."""
+        now = time()
+        init_bandwidth_budget(self.capacity)
+        params = {'capacity': self.capacity, 'now': now, 'rate': self.rate, 'size': self.lease_size,
+                  'process': self.process, 'rank': rank, 'stale': now - WAITER_TTL}
+        db = get_db()
+        with db_lock:
+            # Looked at before writing anything, so a process that has to wait does not keep the database busy.
+            tokens, held_back = db.execute(
+                """
+                select min(:capacity, tokens + max(:now - refilled_at, 0) * :rate), exists (
+                    select 1 from bandwidth_waiters where process != :process and rank < :rank and seen_at > :stale
+                ) from bandwidth_budget where id = 0
+                """, params
+            ).fetchone()
+            if tokens > 0 and not held_back:
+                with db:
+                    taken = db.execute(
+                        """
+                        update bandwidth_budget
+                        set tokens = min(:capacity, tokens + max(:now - refilled_at, 0) * :rate) - :size,
+                            refilled_at = :now
+                        where id = 0 and min(:capacity, tokens + max(:now - refilled_at, 0) * :rate) > 0 and not exists (
+                            select 1 from bandwidth_waiters where process != :process and rank < :rank and seen_at > :stale
+                        )
+                        returning tokens
+                        """, params
+                    ).fetchone()
+                if taken is not None:
+                    self._leased += self.lease_size
+                    return None
+
+            if now - self._announced.get(rank, 0) >= WAITER_TTL / 2:
+                # Let the other processes know this class is waiting, so less urgent ones hold back.
+                with db:
+                    db.execute('insert or replace into bandwidth_waiters values (?, ?, ?)', (self.process, rank, now))
+                self._announced[rank] = now
+
+        if tokens > 0:
+            # Held back by a more urgent class of another process.
+            return POLL_INTERVAL
+
+        return min(max(-tokens / self.rate, 0.01), POLL_INTERVAL)
+
+    def _forget(self, rank):
+        del self._announced[rank]
+        with db_lock, get_db():
+            get_db().execute('delete from bandwidth_waiters where process = ? and rank = ?', (self.process, rank))
+
+    def consume(self, size, rank):
+        waited = 0.0
+        with self._changed:
+            self._waiting[rank] += 1
+            try:
+                while True:
+                    delay = POLL_INTERVAL
+                    if not any(count for other, count in self._waiting.items() if other < rank):
+                        if self._leased > 0:
+                            self._leased -= size
+                            return waited
+
+                        delay = self._lease(rank)
+                        if delay is None:
+                            continue
+
+                    started = monotonic()
+                    self._changed.wait(delay)
+                    waited += monotonic() - started
+            finally:
+                self._waiting[rank] -= 1
+                if not self._waiting[rank] and rank in self._announced:
+                    self._forget(rank)
+
+                self._changed.notify_all()
+
+
+def _create_budget():
+    rate = BANDWIDTH_CONFIG['BYTES_PER_SECOND']
+    # One second worth of burst keeps a freshly started transfer from waiting on its first chunk.
+    return BandwidthBudget(rate, rate) if rate else None
+
+
+budget = _create_budget()
+
+
+def priority_rank(priority):
+    """Rank of a download class, lower is more urgent; unknown classes and None come last. Ranks pass through."""
+    if isinstance(priority, int):
+        return priority
+
+    classes = BANDWIDTH_CONFIG['PRIORITIES']
+    return classes.index(priority) if priority in classes else len(classes)
+
+
+def throttle(size, priority=None):
+    if budget is None:
+        return
+
+    waited = budget.consume(size, priority_rank(priority))
+    if waited:
+        metrics.observe('bandwidth_wait', waited)
+
+
+def saver_active(now=None):
+    """True during ``SAVER_HOURS``, a ``(start, end)`` pair of local hours that may wrap past midnight."""
+    hours = BANDWIDTH_CONFIG['SAVER_HOURS']
+    if not hours:
+        return False
+
+    start, end = hours
+    hour = (now or datetime.now()).hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+def saver_url(result, urls):
+    """
+    The ``large`` rendition of a page to fetch instead of the original while the saver is on, or None.
+
+    ``urls`` is the page's ``image_urls`` or, for single page illusts, ``meta_single_page``
+    whose smaller sizes live on the illust itself.
+    """
+    if not saver_active():
+        return None
+
+    if 'original_image_url' in urls:
+        urls = result.image_urls or {}
+
+    return urls.get('large')
@@ -0,0 +1,147 @@
+from argparse import ArgumentParser
+from json import dump, dumps, load
+from os import environ, pathsep, wait4, waitstatus_to_exitcode
+from os.path import abspath, dirname, exists
+from subprocess import Popen
+from sys import executable
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from mock_server import MockServer, MockSettings
+
+REPO_PATH = dirname(abspath(__file__))
+
+# Run inside the child: point the config at the mock server, then start the entry point as usual.
+BOOTSTRAP = """
+import json, os, config
+overrides = json.loads(os.environ['BENCHMARK_OVERRIDES'])
+config.REFRESH_TOKEN = 'benchmark'
+for name, values in overrides.items():
+    getattr(config, name).update(values)
+{entry}
+"""
+
+ENTRY_POINTS = {
+    'bookmark': 'import pixiv_download_bookmark\npixiv_download_bookmark.main()',
+    'by': 'import pixiv_download_by\npixiv_download_by.main()',
+    'fanbox': 'import pixivfanbox\nraise SystemExit(len(pixivfanbox.pixivfanbox_batch()))',
+    'fanbox-async': 'import pixivfanbox\nraise SystemExit(len(pixivfanbox.pixivfanbox_batch(async_fetch=True)))',
+}
+
+# Metrics summaries are named after the entry point that wrote them.
+SUMMARY_NAMES = {'bookmark': 'bookmark', 'by': 'by', 'fanbox': 'fanbox', 'fanbox-async': 'fanbox'}
+
+
+def _overrides(server, api_rate):
+    return {
+        'API_CONFIG': {'APP_API_HOST': server.url, 'REQUESTS_PER_SECOND': api_rate, 'BURST': max(int(api_rate), 1)},
+        'FANBOX_CONFIG': {'API_BASE': server.url, 'CREATORS': ['benchmark'], 'MAX_DATE': ''},
+        'RETRY_CONFIG': {'BASE_DELAY': 0.05, 'MAX_DELAY': 0.5},
+    }
+
+
+def run_entry_point(name, server, api_rate):
+    """
+    Run one entry point end to end in a fresh working directory and measure it.
+
+    Peak RSS and CPU time come from ``wait4``, so they cover the entry point's own process
+    and every encoder process it reaped.
+    """
+    with TemporaryDirectory(prefix=f'benchmark-{name}-') as work_dir:
+        env = {
+            **environ,
+            'PYTHONPATH': pathsep.join(filter(None, [REPO_PATH, environ.get('PYTHONPATH')])),
+            'BENCHMARK_OVERRIDES': dumps(_overrides(server, api_rate)),
+        }
+        started = perf_counter()
+        process = Popen([executable, '-c', BOOTSTRAP.format(entry=ENTRY_POINTS[name])], cwd=work_dir, env=env)
+        _, status, usage = wait4(process.pid, 0)
+        process.returncode = waitstatus_to_exitcode(status)
+        elapsed = perf_counter() - started
+
+        summary_path = f'{work_dir}/data/metrics/{SUMMARY_NAMES[name]}.json'
+        summary = load(open(summary_path)) if exists(summary_path) else {}
+
+    hosts = summary.get('hosts', {}).values()
+    files = sum(host.get('files', 0) for host in hosts)
+    megabytes = sum(host.get('bytes', 0) for host in hosts) / 1024 ** 2
+    return {
+        'entry_point': name,
+        'exit_code': process.returncode,
+        'seconds': round(elapsed, 3),
+        'files': files,
+        'files_per_second': round(files / elapsed, 3),
+        'mb_per_second': round(megabytes / elapsed, 3),
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3),
+        'stages': summary.get('stages', {}),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return the entry points whose throughput dropped more than ``tolerance`` below the baseline."""
+    previous = {result['entry_point']: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result['entry_point'])
+        if before and result['files_per_second'] < before['files_per_second'] * (1 - tolerance):
+            regressions.append(
+                f'{result["entry_point"]}: {before["files_per_second"]} -> {result["files_per_second"]} files/s')
+
+    return regressions
+
+
+def print_results(results):
+    print(f'{"entry point":<14}{"exit":>5}{"seconds":>10}{"files":>7}{"files/s":>10}{"MB/s":>9}'
+          f'{"peak MB":>9}{"CPU s":>8}')
+    for result in results:
+        print(f'{result["entry_point"]:<14}{result["exit_code"]:>5}{result["seconds"]:>10.2f}{result["files"]:>7}'
+              f'{result["files_per_second"]:>10.2f}{result["mb_per_second"]:>9.2f}'
+              f'{result["peak_rss_mb"]:>9.1f}{result["cpu_seconds"]:>8.2f}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Run the downloaders against a local mock of pixiv and fanbox.')
+    parser.add_argument('entry_points', nargs='*', help=f'any of {", ".join(ENTRY_POINTS)}, all by default')
+    parser.add_argument('--illusts', type=int, default=300)
+    parser.add_argument('--posts', type=int, default=50)
+    parser.add_argument('--image-kb', type=int, default=256)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--bandwidth-kb', type=int, default=0, help='per connection, 0 for unlimited')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 503')
+    parser.add_argument('--truncate-rate', type=float, default=0.0, help='share of file transfers cut short')
+    parser.add_argument('--api-rate', type=float, default=100.0,
+                        help='API requests per second allowed by the token bucket during the run')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed drop in files/s against the baseline before failing')
+    args = parser.parse_args()
+    unknown = set(args.entry_points) - set(ENTRY_POINTS)
+    if unknown:
+        parser.error(f'unknown entry points {sorted(unknown)}')
+
+    mock_settings = MockSettings(
+        illusts=args.illusts,
+        posts=args.posts,
+        image_size=args.image_kb * 1024,
+        latency=args.latency,
+        bandwidth=args.bandwidth_kb * 1024,
+        error_rate=args.error_rate,
+        truncate_rate=args.truncate_rate)
+    with MockServer(mock_settings) as mock_server:
+        benchmark_results = [run_entry_point(name, mock_server, args.api_rate) for name in args.entry_points or ENTRY_POINTS]
+
+    print_results(benchmark_results)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            dump(benchmark_results, fp, indent=2)
+
+    if args.baseline:
+        found = compare(benchmark_results, load(open(args.baseline)), args.tolerance)
+        for line in found:
+            print(f'Regression: {line}')
+
+        if found:
+            exit(1)
@@ -2,9 +2,122 @@ REFRESH_TOKEN = ''
 
 FANBOX_CONFIG = {
     "PIXIV_CREATOR_CONFIG": 'himitsu2',
+    # Sync several creators in one process, PIXIV_CREATOR_CONFIG is used when empty.
+    'CREATORS': [],
+    # Listing starts at posts published before MAX_DATE and stops at posts older than MIN_DATE, both optional.
     'MAX_DATE': '2025-07-12',
+    'MIN_DATE': '',
+    'API_BASE': 'https://api.fanbox.cc',
     'LIMIT_TO_FETCH': 10,
     'BLACKLIST_WORDS': ['デラックス'],
     'WHITE_LIST_DRAWER': [],
-    'SESSION_ID': ''
+    'SESSION_ID': '',
+    # Concurrent post.info requests in --async-fetch mode.
+    'POST_INFO_CONCURRENCY': 8,
+}
+
+DOWNLOAD_CONFIG = {
+    'MAX_WORKERS': 8,
+    'PER_HOST_LIMIT': 4,
+    'HTTP2': False,
+    # Reserve each file's full size before writing it. Turn off on NFS and similar mounts without
+    # native fallocate, where glibc emulates it by writing every block once more.
+    'PREALLOCATE': True,
+    # Pages fetched per multi-page illust, None for all of them. Pages past the limit are
+    # recorded as skipped in the page manifest (see page_manifest.py) rather than dropped silently.
+    'MAX_PAGES_PER_ILLUST': None,
+}
+
+API_CONFIG = {
+    'REQUESTS_PER_SECOND': 0.5,
+    'BURST': 3,
+    # Point pixivpy somewhere else than app-api.pixiv.net, e.g. the benchmark's mock server.
+    'APP_API_HOST': None,
+}
+
+API_CACHE_CONFIG = {
+    'ENABLED': True,
+    # Seconds a response is reused per app API method, None keeps it for good. New works
+    # show up in the listings at most that late. Methods not listed here are never cached.
+    'TTL': {
+        'ugoira_metadata': None,
+        'user_illusts': 900,
+        'user_bookmarks_illust': 900,
+    },
+    # Least recently used responses are evicted past this size (compressed).
+    'MAX_MB': 64,
+}
+
+DEDUP_CONFIG = {
+    # Files whose content was already downloaded elsewhere are linked to the existing copy.
+    'ENABLED': True,
+    # 'hardlink', or 'reflink' for copy-on-write clones on btrfs / xfs (falls back to keeping the copy).
+    'LINK_MODE': 'hardlink',
+}
+
+METRICS_CONFIG = {
+    # Every run writes {SUMMARY_DIR}/{entry point}.json.
+    'SUMMARY_DIR': './data/metrics',
+    # e.g. '/var/lib/node_exporter/textfile/pixiv_{entry_point}.prom', None to skip.
+    'PROMETHEUS_TEXTFILE': None,
+}
+
+RETRY_CONFIG = {
+    # Attempts per request, including the first one.
+    'MAX_ATTEMPTS': 5,
+    # Backoff doubles from BASE_DELAY up to MAX_DELAY seconds, each wait is jittered.
+    'BASE_DELAY': 1.0,
+    'MAX_DELAY': 30.0,
+    # (connect, read) seconds before a stalled request is abandoned, so it fails into a retry instead of hanging.
+    'TIMEOUT': (10, 60),
+}
+
+UGOIRA_CONFIG = {
+    # None uses one encoder process per CPU core.
+    'ENCODE_WORKERS': None,
+    # One of 'gif', 'webp', 'apng' or 'frames' (the raw JPEG frames in a directory).
+    'BOOKMARK_FORMAT': 'gif',
+    'BY_USER_FORMAT': 'frames',
+    'WEBP_QUALITY': 80,
+    # 0 (fastest) to 6 (smallest output).
+    'WEBP_METHOD': 4,
+    'WEBP_LOSSLESS': False,
+    'APNG_COMPRESS_LEVEL': 6,
+}
+
+QUEUE_CONFIG = {
+    # A claimed job goes back to the queue when its worker has not renewed the lease for this long.
+    'LEASE_SECONDS': 300,
+    # Claims per job, including the first, before it is parked as failed.
+    'MAX_ATTEMPTS': 3,
+    'WORKER_PROCESSES': 2,
+    # Seconds between polls of an empty queue with --follow.
+    'POLL_INTERVAL': 5.0,
+}
+
+SCHEDULE_CONFIG = {
+    # Artists whose illusts `scheduler.py` syncs in one process, like pixiv_download_by.USER_ID.
+    'BY_USERS': [],
+    # Accounts whose bookmarks it syncs, like pixiv_download_bookmark.USER_ID.
+    'BOOKMARK_USERS': [],
+}
+
+VERIFY_CONFIG = {
+    # Trees checked by verify.py: the pixiv downloads and the fanbox images.
+    'ROOTS': ['./data/pixivPic', './data/image'],
+    # None uses one checker process per CPU core.
+    'WORKERS': None,
+}
+
+BANDWIDTH_CONFIG = {
+    # Download budget in bytes per second, None for no cap. It is kept in the database, so the bookmark,
+    # by and fanbox scripts and every queue worker running from the same directory share it.
+    'BYTES_PER_SECOND': None,
+    # Download classes, most urgent first. They get the free download slots and the
+    # bandwidth budget in this order, across processes too.
+    'PRIORITIES': ['bookmark', 'by', 'fanbox', 'upgrade'],
+    # (start, end) local hours, e.g. (18, 23), during which pixiv pages are fetched in the
+    # 'large' size. Off-peak runs replace them with the originals. None always fetches originals,
+    # as does crawling with --queue.
+    'SAVER_HOURS': None,
 }
@@ -0,0 +1,101 @@
+from sqlite3 import connect
+from threading import RLock
+
+from loguru import logger
+
+from metrics import metrics
+
+DB_PATH = './pixiv_id_db.db'
+MAX_SQL_VARIABLES = 500
+
+db_lock = RLock()
+_db = None
+
+
+def get_db():
+    """
+    The process-wide connection, opened on first use.
+
+    Download threads record file hashes too, so the connection is shared across threads and
+    writes go through ``db_lock``. Queue workers in other processes write to the same file, so
+    a locked database is waited on rather than failing straight away.
+    """
+    global _db
+    with db_lock:
+        if _db is None:
+            _db = connect(DB_PATH, timeout=30, check_same_thread=False)
+            _db.execute('pragma journal_mode=wal')
+            _db.execute('pragma synchronous=normal')
+
+        return _db
+
+
+def _table_columns(table):
+    # (cid, name, type, notnull, default_value, pk)
+    return get_db().execute(f'pragma table_info({table})').fetchall()
+
+
+def _has_integer_key(table, key_column):
+    columns = _table_columns(table)
+    if not columns:
+        return True
+
+    return any(name == key_column and pk and col_type.lower() == 'integer' for _, name, col_type, _, _, pk in columns)
+
+
+def init_id_table(table, key_column, columns):
+    """
+    Create ``table`` with ``key_column`` as its integer primary key (a rowid alias).
+
+    Tables created by older versions keyed the id as a unique varchar; those are migrated in
+    place, dropping rows whose id is not numeric.
+    """
+    schema = f'{key_column} integer primary key, {columns}'
+    with db_lock:
+        if not _has_integer_key(table, key_column):
+            logger.info(f'Migrating {table} to an integer primary key...')
+            legacy_table = f'{table}_legacy'
+            other_columns = ''.join(f', {column[1]}' for column in _table_columns(table) if column[1] != key_column)
+            with get_db():
+                get_db().execute('begin')
+                get_db().execute(f'alter table {table} rename to {legacy_table}')
+                get_db().execute(f'create table {table} ({schema})')
+                get_db().execute(
+                    f"""
+                    insert or ignore into {table}
+                    select cast({key_column} as integer){other_columns} from {legacy_table}
+                    where {key_column} != '' and {key_column} not glob '*[^0-9]*'
+                    """
+                )
+                get_db().execute(f'drop table {legacy_table}')
+
+        get_db().execute(f'create table if not exists {table} ({schema})')
+        get_db().commit()
+
+
+def select_existing_ids(table, key_column, ids):
+    """Return the subset of ``ids`` already present in ``table`` as a set of ints."""
+    ids = [int(item_id) for item_id in ids]
+    existing = set()
+    with metrics.timer('db'):
+        for start in range(0, len(ids), MAX_SQL_VARIABLES):
+            chunk = ids[start:start + MAX_SQL_VARIABLES]
+            placeholders = ', '.join('?' * len(chunk))
+            existing.update(
+                row[0] for row in get_db().execute(
+                    f'select {key_column} from {table} where {key_column} in ({placeholders})', chunk
+                )
+            )
+
+    metrics.add('skipped_known_ids', len(existing))
+    return existing
+
+
+def insert_rows(table, rows):
+    """Insert or replace all ``rows`` in a single transaction."""
+    if not rows:
+        return
+
+    placeholders = ', '.join('?' * len(rows[0]))
+    with metrics.timer('db'), db_lock, get_db():
+        get_db().executemany(f'insert or replace into {table} values ({placeholders})', rows)
@@ -0,0 +1,183 @@
+from collections import defaultdict
+from hashlib import file_digest, sha256
+from os import link, remove, replace, stat, walk
+from os.path import abspath, exists, join, samestat
+from sys import argv
+
+from loguru import logger
+
+from config import DEDUP_CONFIG
+from database import db_lock, get_db
+from metrics import metrics
+
+# ioctl(dest_fd, FICLONE, src_fd) from linux/fs.h
+FICLONE = 0x40049409
+
+_initialized = False
+
+
+def init_content_hash():
+    global _initialized
+    with db_lock:
+        if _initialized:
+            return
+
+        get_db().execute(
+            """
+            create table if not exists content_hash (
+                path text primary key,
+                sha256 char(64),
+                size integer,
+                url text
+            )
+            """
+        )
+        get_db().execute('create index if not exists content_hash_sha256 on content_hash (sha256)')
+        get_db().commit()
+        _initialized = True
+
+
+def hash_file(path):
+    with open(path, 'rb') as fp:
+        return file_digest(fp, 'sha256')
+
+
+def new_hasher(part_path=None):
+    """A sha256 to feed while streaming, primed with the bytes already in ``part_path`` when resuming."""
+    if part_path is None:
+        return sha256()
+
+    return hash_file(part_path)
+
+
+def _find_copy(digest, size, path):
+    """An existing file with the same content as ``path``, dropping rows whose file is gone or changed."""
+    with db_lock:
+        rows = get_db().execute(
+            'select path from content_hash where sha256 = ? and size = ? and path != ?', (digest, size, path)
+        ).fetchall()
+
+    for (candidate,) in rows:
+        try:
+            if stat(candidate).st_size == size:
+                return candidate
+        except FileNotFoundError:
+            pass
+
+        with db_lock, get_db():
+            get_db().execute('delete from content_hash where path = ?', (candidate,))
+
+    return None
+
+
+def _reflink(source, target):
+    from fcntl import ioctl
+
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_duplicate(source, path, mode=None):
+    """
+    Replace ``path`` with a link to ``source``, which holds the same bytes.
+
+    The link is made next to ``path`` and renamed over it, so ``path`` is never missing.
+    Returns False and leaves the copy alone when the filesystem cannot link them.
+    """
+    mode = mode or DEDUP_CONFIG['LINK_MODE']
+    temp_path = f'{path}.link'
+    try:
+        if mode == 'reflink':
+            _reflink(source, temp_path)
+        else:
+            link(source, temp_path)
+    except (OSError, ImportError) as err:
+        logger.debug(f'Cannot {mode} {path} to {source}: {err!r}')
+        if exists(temp_path):
+            remove(temp_path)
+
+        return False
+
+    replace(temp_path, path)
+    return True
+
+
+def record(path, digest, size, url=None):
+    """
+    Record the content hash of a freshly written file, linking it to an earlier copy if there is one.
+
+    Returns the path of the copy it was linked to, or None.
+    """
+    if not DEDUP_CONFIG['ENABLED']:
+        return None
+
+    init_content_hash()
+    path = abspath(path)
+    with metrics.timer('dedup'):
+        source = _find_copy(digest, size, path)
+        linked = source is not None and link_duplicate(source, path)
+        if linked:
+            metrics.add('dedup_linked_files')
+            metrics.add('dedup_linked_bytes', size)
+            logger.info(f'{path} duplicates {source}, linked instead of keeping a second copy.')
+
+        with db_lock, get_db():
+            get_db().execute('insert or replace into content_hash values (?, ?, ?, ?)', (path, digest, size, url))
+
+    return source if linked else None
+
+
+def dedupe_tree(root, mode=None):
+    """
+    One-off pass linking together identical files already under ``root``.
+
+    Files are grouped by size first, so only sizes seen more than once are hashed. Every
+    hashed file is recorded, letting later downloads link against it.
+    """
+    init_content_hash()
+    by_size = defaultdict(list)
+    for directory, _, names in walk(root):
+        for name in names:
+            if name.endswith(('.part', '.len', '.link')):
+                continue
+
+            path = abspath(join(directory, name))
+            by_size[stat(path).st_size].append(path)
+
+    linked_count = saved_bytes = 0
+    for size, paths in by_size.items():
+        if len(paths) < 2 or not size:
+            continue
+
+        originals = {}
+        for path in paths:
+            digest = hash_file(path).hexdigest()
+            with db_lock, get_db():
+                # Keeps the URL the downloader recorded, verify.py requeues corrupt files from it.
+                get_db().execute(
+                    """
+                    insert into content_hash (path, sha256, size) values (?, ?, ?)
+                    on conflict (path) do update set sha256 = excluded.sha256, size = excluded.size
+                    """,
+                    (path, digest, size)
+                )
+
+            if digest not in originals:
+                originals[digest] = path
+                continue
+
+            source = originals[digest]
+            if samestat(stat(source), stat(path)):
+                continue
+
+            if link_duplicate(source, path, mode):
+                linked_count += 1
+                saved_bytes += size
+
+    logger.success(f'Linked {linked_count} duplicate files under {root}, {saved_bytes / 1024 ** 2:.1f} MB reclaimed.')
+    return linked_count, saved_bytes
+
+
+if __name__ == '__main__':
+    # python dedup.py data [reflink]
+    dedupe_tree(argv[1] if len(argv) > 1 else 'data', argv[2] if len(argv) > 2 else None)
@@ -0,0 +1,74 @@
+from os import scandir
+from os.path import abspath, basename, dirname, normcase
+from threading import Lock
+
+from loguru import logger
+
+from metrics import metrics
+
+
+class DirectoryIndex:
+    """
+    Names of the entries in one directory, listed with a single ``scandir`` pass.
+
+    Checking a candidate file against the index replaces a ``stat`` per file, which on a
+    network mount is a round trip each. Writers keep it current through ``add`` and
+    ``discard``; changes made by other processes during the run are not seen.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._names = set()
+        self._lock = Lock()
+        try:
+            with scandir(directory) as entries:
+                self._names.update(normcase(entry.name) for entry in entries)
+        except FileNotFoundError:
+            pass
+
+        logger.debug(f'Indexed {len(self._names)} entries of {directory}.')
+
+    def __contains__(self, name):
+        return normcase(name) in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name):
+        with self._lock:
+            self._names.add(normcase(name))
+
+    def discard(self, name):
+        with self._lock:
+            self._names.discard(normcase(name))
+
+
+_indexes = {}
+_lock = Lock()
+
+
+def get_index(directory) -> DirectoryIndex:
+    """The index of ``directory``, built on first use and shared for the rest of the process."""
+    key = normcase(abspath(directory))
+    with _lock:
+        if key not in _indexes:
+            _indexes[key] = DirectoryIndex(directory)
+
+        return _indexes[key]
+
+
+def path_exists(path):
+    """Drop-in for ``os.path.exists`` on files whose directory is indexed."""
+    if basename(path) in get_index(dirname(path) or '.'):
+        metrics.add('skipped_existing_files')
+        return True
+
+    return False
+
+
+def mark_written(path):
+    get_index(dirname(path) or '.').add(basename(path))
+
+
+def mark_removed(path):
+    get_index(dirname(path) or '.').discard(basename(path))
@@ -0,0 +1,288 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from heapq import heappop, heappush
+from itertools import count
+from os import remove, replace
+from os.path import exists, getsize
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+from urllib.parse import urlparse
+
+from loguru import logger
+
+from bandwidth import priority_rank, throttle
+from config import DOWNLOAD_CONFIG
+from dedup import hash_file, new_hasher, record
+from dir_index import mark_written
+from http_session import iter_body, open_stream
+from metrics import metrics
+from retry import TransientError, download_retry
+
+try:
+    from os import posix_fallocate
+except ImportError:
+    # Not available on Windows, files are then grown as they are written.
+    posix_fallocate = None
+
+PIXIV_HEADERS = {'Referer': 'https://app-api.pixiv.net/'}
+PROGRESS_INTERVAL = 0.25
+# How often a preallocated part file records how much of it holds data.
+VALID_LENGTH_INTERVAL = 4 * 1024 ** 2
+
+
+def _total_from_content_range(content_range):
+    # e.g. "bytes 1000-4999/5000" or "bytes */5000"
+    if not content_range or '/' not in content_range:
+        return 0
+
+    total = content_range.rsplit('/', 1)[-1]
+    return int(total) if total.isdigit() else 0
+
+
+def _save_valid_length(length_path, length):
+    with open(length_path, 'w') as fp:
+        fp.write(str(length))
+
+
+def _resume_offset(part_path):
+    """Bytes of ``part_path`` holding data; the tail of a preallocated part file is dropped first."""
+    length_path = f'{part_path}.len'
+    if not exists(length_path):
+        return getsize(part_path) if exists(part_path) else 0
+
+    try:
+        with open(length_path) as fp:
+            valid_length = int(fp.read())
+    except ValueError:
+        # Killed while rewriting the length, the part file is fetched again.
+        valid_length = 0
+
+    if exists(part_path):
+        valid_length = min(valid_length, getsize(part_path))
+        with open(part_path, 'r+b') as fp:
+            fp.truncate(valid_length)
+    else:
+        valid_length = 0
+
+    # Only once the tail is gone, a full size part file without its length would pass for a finished one.
+    remove(length_path)
+    return valid_length
+
+
+def _write_body(response, fp, offset, total_size, hasher, title, show_progress, priority=None, length_path=None):
+    written_size = saved_size = offset
+    last_progress = 0.0
+    for chunk in iter_body(response):
+        throttle(len(chunk), priority)
+        written_size += len(chunk)
+        fp.write(chunk)
+        hasher.update(chunk)
+        if length_path and written_size - saved_size >= VALID_LENGTH_INTERVAL:
+            fp.flush()
+            _save_valid_length(length_path, written_size)
+            saved_size = written_size
+
+        if show_progress and total_size and (
+                perf_counter() - last_progress >= PROGRESS_INTERVAL or written_size >= total_size):
+            last_progress = perf_counter()
+            print(f'Downloading {title}:  {written_size / total_size * 100:.1f}%',
+                  end='\r' if written_size < total_size else '\n', flush=True)
+
+    return written_size
+
+
+def _write_preallocated(response, part_path, total_size, hasher, title, show_progress, priority=None):
+    """
+    Write a fresh download into a part file preallocated to ``total_size``.
+
+    The part file's size then no longer tells how much of it was received, so the valid
+    length is kept next to it in ``.len``, every ``VALID_LENGTH_INTERVAL`` bytes. A killed
+    process leaves both behind and the next attempt resumes from the recorded length. Where
+    the filesystem refuses to preallocate, the file is written as it comes instead.
+    """
+    length_path = f'{part_path}.len'
+    # Recorded before the file grows, a full size part file without it would pass for a finished one.
+    _save_valid_length(length_path, 0)
+    with open(part_path, 'wb') as fp:
+        try:
+            posix_fallocate(fp.fileno(), 0, total_size)
+        except OSError as err:
+            # e.g. EOPNOTSUPP on filesystems without fallocate, the file then grows as it is written.
+            logger.debug(f'Cannot preallocate {part_path}: {err!r}')
+
+        try:
+            return _write_body(response, fp, 0, total_size, hasher, title, show_progress, priority, length_path)
+        finally:
+            # Writes are sequential, so the position is exactly the number of bytes received.
+            fp.truncate(fp.tell())
+            remove(length_path)
+
+
+def download(url, path, title, headers=None, show_progress=True, priority=None):
+    """
+    Stream ``url`` into ``path``, drawing from the bandwidth budget of the ``priority`` class.
+
+    Data is written to ``path + '.part'`` first. An existing part file from an interrupted
+    run is resumed with a ``Range`` request when the server honors it, and the part file is
+    only renamed to ``path`` once its size matches the advertised length. The content is
+    hashed on the way to disk, so a file already downloaded elsewhere gets linked to it.
+    """
+    started = perf_counter()
+    part_path = f'{path}.part'
+    offset = _resume_offset(part_path)
+    request_headers = dict(headers or PIXIV_HEADERS)
+    if offset:
+        request_headers['Range'] = f'bytes={offset}-'
+
+    with open_stream(url, request_headers) as r:
+        if offset and r.status_code == 416:
+            if _total_from_content_range(r.headers.get('content-range')) == offset:
+                logger.info(f'Part file of {path} was already complete.')
+                replace(part_path, path)
+                mark_written(path)
+                record(path, hash_file(path).hexdigest(), offset, url)
+                return path
+
+            logger.warning(f'Cannot resume {path}, starting over.')
+            remove(part_path)
+            return download(url, path, title, headers=headers, show_progress=show_progress, priority=priority)
+
+        r.raise_for_status()
+        if offset and r.status_code == 206:
+            logger.info(f'Resuming {path} from byte {offset}.')
+        else:
+            offset = 0
+
+        hasher = new_hasher(part_path if offset else None)
+
+        # Streaming responses must not be read up front, so an unknown length only disables the percentage.
+        content_length = int(r.headers.get('content-length') or 0)
+        total_size = _total_from_content_range(r.headers.get('content-range')) or (
+            offset + content_length if content_length else 0)
+        if offset or not total_size or posix_fallocate is None or not DOWNLOAD_CONFIG['PREALLOCATE']:
+            with open(part_path, 'ab' if offset else 'wb') as fp:
+                written_size = _write_body(r, fp, offset, total_size, hasher, title, show_progress, priority)
+        else:
+            written_size = _write_preallocated(r, part_path, total_size, hasher, title, show_progress, priority)
+
+    if total_size and getsize(part_path) != total_size:
+        raise TransientError(f'Incomplete download of {path}: {getsize(part_path)} of {total_size} bytes, will resume.')
+
+    replace(part_path, path)
+    mark_written(path)
+    record(path, hasher.hexdigest(), written_size, url)
+
+    host = urlparse(url).netloc
+    metrics.observe('download', perf_counter() - started, host)
+    metrics.add('files', 1, host)
+    metrics.add('bytes', written_size - offset, host)
+    logger.success(f'Download done {path}.')
+    return path
+
+
+class DownloadPool:
+    """
+    Bounded worker pool for file downloads.
+
+    At most ``MAX_WORKERS`` downloads run at once, and at most ``PER_HOST_LIMIT`` of them
+    against the same host. ``submit`` returns a future resolving to the written path, so
+    callers can wait on every page of an illust before recording it. Queued downloads start
+    in the order of their ``priority`` class (see ``BANDWIDTH_CONFIG``), then in submission
+    order. A path submitted while it is still downloading gets the running download's
+    future, so users synced side by side never write the same file twice at once.
+    """
+
+    def __init__(self, max_workers=None, per_host_limit=None):
+        self.max_workers = max_workers or DOWNLOAD_CONFIG['MAX_WORKERS']
+        self.per_host_limit = per_host_limit or DOWNLOAD_CONFIG['PER_HOST_LIMIT']
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='download')
+        self._host_limits = {}
+        self._in_flight = {}
+        self._queued = []
+        self._sequence = count()
+        self._lock = Lock()
+
+        self.file_count = 0
+        self.byte_count = 0
+        self._started = perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def _host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = BoundedSemaphore(self.per_host_limit)
+
+            return self._host_limits[host]
+
+    def _download(self, url, path, title, headers, priority):
+        with self._host_semaphore(url):
+            download(url, path, title, headers=headers, show_progress=self.max_workers == 1, priority=priority)
+
+    def _run(self, url, path, title, headers, priority):
+        # Retries back off outside the host semaphore so a flaky file does not hold a slot.
+        download_retry.call(self._download, url, path, title, headers, priority)
+
+        size = getsize(path)
+        with self._lock:
+            self.file_count += 1
+            self.byte_count += size
+
+        return path
+
+    def _finished(self, path):
+        with self._lock:
+            del self._in_flight[path]
+
+    def _run_next(self):
+        # Every submit queues one of these, so each picks up whichever queued download is most urgent.
+        with self._lock:
+            _, _, future, args = heappop(self._queued)
+
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            future.set_result(self._run(*args))
+        except Exception as err:
+            future.set_exception(err)
+
+    def submit(self, url, path, title, headers=None, priority=None):
+        with self._lock:
+            if path in self._in_flight:
+                return self._in_flight[path]
+
+            rank = priority_rank(priority)
+            future = self._in_flight[path] = Future()
+            heappush(self._queued, (rank, next(self._sequence), future, (url, path, title, headers, rank)))
+
+        future.add_done_callback(lambda _: self._finished(path))
+        self._executor.submit(self._run_next)
+        return future
+
+    def report(self):
+        elapsed = max(perf_counter() - self._started, 1e-6)
+        megabytes = self.byte_count / 1024 ** 2
+        logger.success(
+            f'Downloaded {self.file_count} files, {megabytes:.1f} MB in {elapsed:.1f}s '
+            f'({self.file_count / elapsed:.2f} files/s, {megabytes / elapsed:.2f} MB/s)')
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def wait_all(futures):
+    """Wait for every future and return True only if all of them finished without raising."""
+    succeeded = True
+    for future in futures:
+        try:
+            future.result()
+        except Exception as err:
+            logger.error(f'Download failed: {err!r}')
+            succeeded = False
+
+    return succeeded
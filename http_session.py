@@ -0,0 +1,103 @@
+from importlib.util import find_spec
+from threading import Lock
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+from config import DOWNLOAD_CONFIG, RETRY_CONFIG
+
+HTTP2_HOSTS = ('i.pximg.net',)
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+_session = None
+_http2_client = None
+_http2_checked = False
+_lock = Lock()
+
+
+def _pool_size():
+    return max(DOWNLOAD_CONFIG['MAX_WORKERS'], DOWNLOAD_CONFIG['PER_HOST_LIMIT'])
+
+
+def get_session() -> requests.Session:
+    """Process-wide keep-alive session, its connection pool sized to the download concurrency."""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=_pool_size())
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+
+        return _session
+
+
+def share_pool(session: requests.Session):
+    """Mount the shared connection pool on another session, e.g. a cloudflare scraper."""
+    shared = get_session()
+    session.mount('https://', shared.get_adapter('https://'))
+    session.mount('http://', shared.get_adapter('http://'))
+    return session
+
+
+def get_http2_client():
+    """HTTP/2 client for the pixiv image CDN, or None when disabled or ``h2`` is not installed."""
+    global _http2_client, _http2_checked
+    with _lock:
+        if not _http2_checked:
+            _http2_checked = True
+            if not DOWNLOAD_CONFIG['HTTP2']:
+                return None
+
+            if find_spec('h2') is None:
+                logger.warning('HTTP2 is enabled but the h2 package is not installed, using HTTP/1.1.')
+                return None
+
+            from httpx import Client, Limits, Timeout
+
+            connect_timeout, read_timeout = RETRY_CONFIG['TIMEOUT']
+            _http2_client = Client(
+                http2=True,
+                limits=Limits(max_connections=_pool_size(), max_keepalive_connections=_pool_size()),
+                timeout=Timeout(read_timeout, connect=connect_timeout),
+            )
+
+        return _http2_client
+
+
+def open_stream(url, headers):
+    """Open a streaming GET through the shared pool, preferring HTTP/2 for the image CDN."""
+    if url.split('/')[2] in HTTP2_HOSTS:
+        client = get_http2_client()
+        if client is not None:
+            return client.stream('GET', url, headers=headers)
+
+    return get_session().get(url, stream=True, headers=headers, timeout=RETRY_CONFIG['TIMEOUT'])
+
+
+def iter_body(response, chunk_size=MIN_CHUNK_SIZE, max_chunk_size=MAX_CHUNK_SIZE):
+    """
+    Yield the body in chunks read into one reusable buffer, doubling it while reads keep filling it.
+
+    The yielded memoryviews are only valid until the next chunk is requested. httpx has no
+    ``readinto``, there the chunks are passed on as they come off the connection. Reading
+    the raw stream skips requests' exception wrapping, so a stalled read raises urllib3's
+    ``ReadTimeoutError``.
+    """
+    if hasattr(response, 'iter_bytes'):
+        yield from response.iter_bytes()
+        return
+
+    raw = response.raw
+    raw.decode_content = True
+    buffer = memoryview(bytearray(chunk_size))
+    while True:
+        read_size = raw.readinto(buffer)
+        if not read_size:
+            return
+
+        yield buffer[:read_size]
+        if read_size == len(buffer) and len(buffer) < max_chunk_size:
+            buffer = memoryview(bytearray(len(buffer) * 2))
@@ -0,0 +1,377 @@
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from contextlib import contextmanager
+from json import dumps, loads
+from multiprocessing import get_context
+from os import getpid
+from socket import gethostname
+from time import sleep, time
+
+from loguru import logger
+
+from bandwidth import priority_rank
+from config import DOWNLOAD_CONFIG, QUEUE_CONFIG
+from database import db_lock, get_db
+from dir_index import path_exists
+from downloader import DownloadPool
+from metrics import metrics, write_summary
+from ugoira import EncodePool
+
+_initialized = False
+
+
+def init_job_queue():
+    global _initialized
+    with db_lock:
+        if _initialized:
+            return
+
+        get_db().execute(
+            """
+            create table if not exists job_owners (
+                owner_table varchar(50),
+                owner_id integer,
+                owner_row text,
+                primary key (owner_table, owner_id)
+            )
+            """
+        )
+        get_db().execute(
+            """
+            create table if not exists download_jobs (
+                job_id integer primary key,
+                owner_table varchar(50),
+                owner_id integer,
+                kind varchar(20),
+                url text,
+                path text,
+                title text,
+                headers text,
+                encode text,
+                state varchar(10) default 'pending',
+                claimed_by varchar(100),
+                claimed_at real,
+                attempts integer default 0,
+                error text,
+                priority integer default 0
+            )
+            """
+        )
+        columns = [column[1] for column in get_db().execute('pragma table_info(download_jobs)')]
+        if 'priority' not in columns:
+            get_db().execute('alter table download_jobs add column priority integer default 0')
+
+        get_db().execute('create index if not exists download_jobs_claim on download_jobs (state, priority, job_id)')
+        get_db().execute('create index if not exists download_jobs_owner on download_jobs (owner_table, owner_id)')
+        get_db().commit()
+        _initialized = True
+
+
+class QueuedJob:
+    """A download (optionally followed by a ugoira encode) waiting to be written to the queue."""
+
+    def __init__(self, kind, url, path, title, headers=None, priority=None):
+        self.kind = kind
+        self.url = url
+        self.path = path
+        self.title = title
+        self.headers = headers
+        self.priority = priority_rank(priority)
+        self.encode = None
+
+    def values(self, owner_table, owner_id):
+        return (
+            owner_table, owner_id, self.kind, self.url, self.path, self.title,
+            dumps(self.headers) if self.headers else None,
+            dumps(self.encode) if self.encode else None,
+            self.priority,
+        )
+
+
+class QueuedDownloads:
+    """Stands in for ``DownloadPool`` when crawling only: ``submit`` describes the job instead of running it."""
+
+    def __init__(self):
+        self.job_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def submit(self, url, path, title, headers=None, priority=None):
+        self.job_count += 1
+        return QueuedJob('file', url, path, title, headers, priority)
+
+    def report(self):
+        logger.success(f'Queued {self.job_count} downloads, run the queue workers to fetch them.')
+
+
+class QueuedEncodes:
+    """Stands in for ``EncodePool``, attaching the encode to the zip's download job."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    @staticmethod
+    def submit(zip_path, output_path, frames, fmt='gif', after=None, frame_prefix=None):
+        job = after or QueuedJob('encode', None, zip_path, None)
+        if after is not None:
+            job.kind = 'ugoira'
+
+        job.encode = {
+            'output_path': output_path,
+            'frames': [{'file': frame['file'], 'delay': frame['delay']} for frame in frames],
+            'fmt': fmt,
+            'frame_prefix': frame_prefix,
+        }
+        return job
+
+
+@contextmanager
+def open_pools(use_queue=False):
+    """``(encoder, pool)`` for a crawler: the real pools, or their queueing stand-ins."""
+    if use_queue:
+        yield QueuedEncodes(), QueuedDownloads()
+        return
+
+    with EncodePool() as encoder, DownloadPool() as pool:
+        yield encoder, pool
+
+
+def _complete_owner(owner_table, owner_id):
+    # Runs inside the caller's transaction, so the owner row and its acks land together.
+    db = get_db()
+    (owner_row,) = db.execute(
+        'select owner_row from job_owners where owner_table = ? and owner_id = ?', (owner_table, owner_id)
+    ).fetchone()
+    row = loads(owner_row)
+    db.execute(f'insert or replace into {owner_table} values ({", ".join("?" * len(row))})', row)
+    db.execute('delete from job_owners where owner_table = ? and owner_id = ?', (owner_table, owner_id))
+    db.execute('delete from download_jobs where owner_table = ? and owner_id = ?', (owner_table, owner_id))
+
+
+def enqueue(owner_table, owners):
+    """
+    Queue the jobs of every ``(row, jobs)`` pair; ``row`` goes into ``owner_table`` once all its jobs are acked.
+
+    Owners already in the queue are skipped, so crawling the same page twice does not queue
+    its files twice. Owners without jobs are recorded straight away.
+    """
+    if not owners:
+        return
+
+    init_job_queue()
+    queued_jobs = 0
+    with metrics.timer('db'), db_lock, get_db():
+        db = get_db()
+        for row, jobs in owners:
+            owner_id = row[0]
+            inserted = db.execute(
+                'insert or ignore into job_owners values (?, ?, ?)', (owner_table, owner_id, dumps(row))
+            ).rowcount
+            if not inserted:
+                logger.debug(f'{owner_table} {owner_id} is already queued.')
+                continue
+
+            if not jobs:
+                _complete_owner(owner_table, owner_id)
+                continue
+
+            db.executemany(
+                'insert into download_jobs (owner_table, owner_id, kind, url, path, title, headers, encode, priority) '
+                'values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [job.values(owner_table, owner_id) for job in jobs]
+            )
+            queued_jobs += len(jobs)
+
+    metrics.add('queued_jobs', queued_jobs)
+
+
+def claim(worker, limit):
+    """
+    Lease up to ``limit`` pending jobs to ``worker``, the most urgent priority class first.
+
+    Jobs whose lease ran out, because their worker died or hung, are handed out again.
+    """
+    now = time()
+    with metrics.timer('db'), db_lock, get_db():
+        return get_db().execute(
+            """
+            update download_jobs set state = 'claimed', claimed_by = ?, claimed_at = ?, attempts = attempts + 1
+            where job_id in (
+                select job_id from download_jobs
+                where state = 'pending' or (state = 'claimed' and claimed_at < ?)
+                order by priority, job_id limit ?
+            )
+            returning job_id, url, path, title, headers, encode, priority
+            """,
+            (worker, now, now - QUEUE_CONFIG['LEASE_SECONDS'], limit)
+        ).fetchall()
+
+
+def renew(worker):
+    with db_lock, get_db():
+        get_db().execute(
+            "update download_jobs set claimed_at = ? where claimed_by = ? and state = 'claimed'", (time(), worker))
+
+
+def ack(job_id):
+    """Mark a job done, recording its owner if that was the last one outstanding."""
+    with metrics.timer('db'), db_lock, get_db():
+        db = get_db()
+        db.execute("update download_jobs set state = 'done', claimed_by = null where job_id = ?", (job_id,))
+        owner = db.execute('select owner_table, owner_id from download_jobs where job_id = ?', (job_id,)).fetchone()
+        if owner is None:
+            # A worker whose lease ran out finished after another one had already completed the owner.
+            return
+
+        owner_table, owner_id = owner
+        (remaining,) = db.execute(
+            "select count(*) from download_jobs where owner_table = ? and owner_id = ? and state != 'done'",
+            (owner_table, owner_id)
+        ).fetchone()
+        if not remaining:
+            _complete_owner(owner_table, owner_id)
+
+
+def fail(job_id, err):
+    """Give a job back to the queue, or park it as failed once it used up its attempts."""
+    with db_lock, get_db():
+        get_db().execute(
+            """
+            update download_jobs
+            set state = case when attempts >= ? then 'failed' else 'pending' end, claimed_by = null, error = ?
+            where job_id = ?
+            """,
+            (QUEUE_CONFIG['MAX_ATTEMPTS'], repr(err), job_id)
+        )
+
+
+def retry_failed():
+    init_job_queue()
+    with db_lock, get_db():
+        return get_db().execute(
+            "update download_jobs set state = 'pending', attempts = 0, error = null where state = 'failed'").rowcount
+
+
+def queue_status():
+    init_job_queue()
+    with db_lock:
+        counts = dict(get_db().execute('select state, count(*) from download_jobs group by state').fetchall())
+        (owners,) = get_db().execute('select count(*) from job_owners').fetchone()
+
+    return {'owners': owners, **counts}
+
+
+def _start(pool, encoder, url, path, title, headers, encode, priority):
+    """Run one claimed job, returning a future or None when its output is already on disk."""
+    headers = loads(headers) if headers else None
+    if encode is None:
+        return None if path_exists(path) else pool.submit(url, path, title, headers, priority)
+
+    encode = loads(encode)
+    if path_exists(encode['output_path']):
+        return None
+
+    # A zip already on disk means an earlier attempt died between the download and the encode.
+    after = None if url is None or path_exists(path) else pool.submit(url, path, title, headers, priority)
+    return encoder.submit(path, encode['output_path'], encode['frames'], encode['fmt'], after, encode['frame_prefix'])
+
+
+def _drain(worker, follow):
+    init_job_queue()
+    capacity = DOWNLOAD_CONFIG['MAX_WORKERS'] * 2
+    # Jobs of the same path share the pool's future, e.g. two bookmarks whose author and title match.
+    in_flight = {}
+    claimed_jobs = 0
+    with EncodePool() as encoder, DownloadPool() as pool:
+        while True:
+            claimed = claim(worker, capacity - claimed_jobs) if claimed_jobs < capacity else []
+            for job_id, *job in claimed:
+                try:
+                    future = _start(pool, encoder, *job)
+                except Exception as err:
+                    future = Future()
+                    future.set_exception(err)
+
+                if future is None:
+                    ack(job_id)
+                else:
+                    in_flight.setdefault(future, []).append(job_id)
+                    claimed_jobs += 1
+
+            if not in_flight:
+                # A batch that was already on disk is acked at once, the queue may still hold more.
+                if claimed:
+                    continue
+
+                if not follow:
+                    break
+
+                sleep(QUEUE_CONFIG['POLL_INTERVAL'])
+                continue
+
+            done, _ = wait(in_flight, timeout=QUEUE_CONFIG['LEASE_SECONDS'] / 3, return_when=FIRST_COMPLETED)
+            renew(worker)
+            for future in done:
+                job_ids = in_flight.pop(future)
+                claimed_jobs -= len(job_ids)
+                for job_id in job_ids:
+                    if future.exception() is None:
+                        ack(job_id)
+                    else:
+                        logger.error(f'Job {job_id} failed: {future.exception()!r}')
+                        fail(job_id, future.exception())
+
+    pool.report()
+
+
+def run_worker(index=0, follow=False):
+    worker = f'{gethostname()}:{getpid()}'
+    logger.info(f'Queue worker {worker} started.')
+    try:
+        _drain(worker, follow)
+    finally:
+        write_summary(f'worker-{index}')
+
+
+def work(processes=None, follow=False):
+    """
+    Drain the queue with ``processes`` worker processes, each with its own download and encode pools.
+
+    Without ``follow`` the workers exit once the queue is empty.
+    """
+    processes = processes or QUEUE_CONFIG['WORKER_PROCESSES']
+    if processes == 1:
+        run_worker(0, follow)
+        return 0
+
+    # Spawned rather than forked, so no worker inherits the parent's SQLite connection.
+    context = get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(index, follow)) for index in range(processes)]
+    for process in workers:
+        process.start()
+
+    for process in workers:
+        process.join()
+
+    return sum(1 for process in workers if process.exitcode)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Download the jobs queued by the crawlers.')
+    parser.add_argument('command', nargs='?', default='work', choices=['work', 'status', 'retry-failed'])
+    parser.add_argument('--processes', type=int, help='worker processes, defaults to QUEUE_CONFIG')
+    parser.add_argument('--follow', action='store_true', help='keep polling for new jobs instead of exiting')
+    args = parser.parse_args()
+    if args.command == 'status':
+        print(queue_status())
+    elif args.command == 'retry-failed':
+        logger.info(f'Requeued {retry_failed()} failed jobs.')
+    else:
+        exit(work(args.processes, args.follow))
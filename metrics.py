@@ -0,0 +1,133 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from json import dump
+from os import makedirs, replace
+from os.path import dirname
+from threading import Lock
+from time import perf_counter, time
+
+from loguru import logger
+
+from config import METRICS_CONFIG
+
+
+class Metrics:
+    """
+    Process-wide stage timers and counters for one run.
+
+    Timers accumulate call count, total and max seconds per stage (``api``, ``download``,
+    ``db``, ``encode``, ...). Both timers and counters can carry a ``host`` label, which is
+    how transfer rates are broken down per CDN.
+    """
+
+    def __init__(self):
+        self._timers = defaultdict(lambda: [0, 0.0, 0.0])
+        self._counters = defaultdict(int)
+        self._lock = Lock()
+        self._started = perf_counter()
+        self._started_at = time()
+
+    def add(self, name, value=1, host=None):
+        with self._lock:
+            self._counters[name, host] += value
+
+    def observe(self, stage, seconds, host=None):
+        with self._lock:
+            timer = self._timers[stage, host]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, stage, host=None):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, perf_counter() - started, host)
+
+    def summary(self, entry_point):
+        elapsed = perf_counter() - self._started
+        with self._lock:
+            timers = {key: list(value) for key, value in self._timers.items()}
+            counters = dict(self._counters)
+
+        stages = {}
+        hosts = defaultdict(dict)
+        for (stage, host), (count, seconds, longest) in timers.items():
+            timing = {'count': count, 'seconds': round(seconds, 3), 'max_seconds': round(longest, 3)}
+            (hosts[host] if host else stages)[stage] = timing
+
+        totals = {}
+        for (name, host), value in counters.items():
+            if host:
+                hosts[host][name] = value
+            else:
+                totals[name] = value
+
+        for host, host_metrics in hosts.items():
+            seconds = host_metrics.get('download', {}).get('seconds')
+            if seconds:
+                host_metrics['mb_per_second'] = round(host_metrics.get('bytes', 0) / 1024 ** 2 / seconds, 3)
+
+        files = sum(host_metrics.get('files', 0) for host_metrics in hosts.values())
+        return {
+            'entry_point': entry_point,
+            'started_at': round(self._started_at, 3),
+            'elapsed_seconds': round(elapsed, 3),
+            'files_per_second': round(files / max(elapsed, 1e-6), 3),
+            'stages': stages,
+            'counters': totals,
+            'hosts': hosts,
+        }
+
+    def prometheus(self, entry_point):
+        """The same numbers in the Prometheus text exposition format, for node_exporter's textfile collector."""
+        with self._lock:
+            timers = dict(self._timers)
+            counters = dict(self._counters)
+
+        lines = []
+        for (stage, host), (count, seconds, _) in sorted(timers.items(), key=str):
+            labels = _labels(entry_point, stage=stage, host=host)
+            lines.append(f'pixiv_stage_seconds_total{labels} {seconds:.6f}')
+            lines.append(f'pixiv_stage_calls_total{labels} {count}')
+
+        for (name, host), value in sorted(counters.items(), key=str):
+            lines.append(f'pixiv_{name}_total{_labels(entry_point, host=host)} {value}')
+
+        lines.append(f'pixiv_run_seconds{_labels(entry_point)} {perf_counter() - self._started:.3f}')
+        lines.append(f'pixiv_run_finished_timestamp_seconds{_labels(entry_point)} {time():.0f}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(entry_point, **labels):
+    labels = {'entry_point': entry_point, **{key: value for key, value in labels.items() if value}}
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def _write_atomic(path, write):
+    if dirname(path):
+        makedirs(dirname(path), exist_ok=True)
+
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as fp:
+        write(fp)
+
+    replace(f'{path}.tmp', path)
+
+
+metrics = Metrics()
+
+
+def write_summary(entry_point):
+    """Write the run summary as JSON, and as a Prometheus textfile when one is configured."""
+    summary = metrics.summary(entry_point)
+    json_path = f'{METRICS_CONFIG["SUMMARY_DIR"]}/{entry_point}.json'
+    _write_atomic(json_path, lambda fp: dump(summary, fp, indent=2))
+    logger.info(f'Run summary written to {json_path}: {summary["stages"]}')
+
+    textfile = METRICS_CONFIG['PROMETHEUS_TEXTFILE']
+    if textfile:
+        _write_atomic(textfile.format(entry_point=entry_point), lambda fp: fp.write(metrics.prometheus(entry_point)))
+
+    return summary
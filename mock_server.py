@@ -0,0 +1,273 @@
+from argparse import ArgumentParser
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from json import dumps
+from random import Random
+from sys import exc_info
+from threading import Thread
+from time import perf_counter, sleep
+from urllib.parse import parse_qs, urlparse
+from zipfile import ZipFile
+
+from PIL import Image
+
+PAGE_SIZE = 30
+FANBOX_PAGE_SIZE = 10
+WRITE_CHUNK = 64 * 1024
+
+
+class MockSettings:
+    """
+    Shape of the emulated archive and of the network in front of it.
+
+    ``latency`` is added to every response, ``bandwidth`` caps each connection in bytes per
+    second (0 for unlimited), ``error_rate`` is the share of requests answered with a 503 and
+    ``truncate_rate`` the share of file transfers cut off halfway.
+    """
+
+    def __init__(self, illusts=300, pages_per_illust=3, ugoira_every=10, image_size=256 * 1024,
+                 posts=50, images_per_post=4, latency=0.0, bandwidth=0, error_rate=0.0,
+                 truncate_rate=0.0, seed=0):
+        self.illusts = illusts
+        self.pages_per_illust = pages_per_illust
+        self.ugoira_every = ugoira_every
+        self.image_size = image_size
+        self.posts = posts
+        self.images_per_post = images_per_post
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.seed = seed
+
+
+def _ugoira_zip(frame_count=12, size=(240, 240)):
+    archive = BytesIO()
+    with ZipFile(archive, 'w') as zip_file:
+        for idx in range(frame_count):
+            frame = BytesIO()
+            Image.new('RGB', size, (idx * 20 % 256, 80, 255 - idx * 20 % 256)).save(frame, 'JPEG')
+            zip_file.writestr(f'{idx:06d}.jpg', frame.getvalue())
+
+    return archive.getvalue(), [{'file': f'{idx:06d}.jpg', 'delay': 60} for idx in range(frame_count)]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'MockServer'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self._dispatch()
+
+    def do_GET(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        settings = self.server.settings
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if settings.latency:
+            sleep(settings.latency)
+
+        if url.path != '/auth/token' and self.server.random_chance(settings.error_rate):
+            return self._send_json({'error': {'user_message': '', 'message': 'injected', 'reason': ''}}, status=503)
+
+        routes = {
+            '/auth/token': self._auth,
+            '/v1/user/bookmarks/illust': self._bookmarks,
+            '/v1/user/illusts': self._user_illusts,
+            '/v1/ugoira/metadata': self._ugoira_metadata,
+            '/post.listCreator': self._list_creator,
+            '/post.info': self._post_info,
+        }
+        if url.path in routes:
+            return routes[url.path](query)
+
+        if url.path.startswith('/img/'):
+            return self._send_file(url.path)
+
+        self._send_json({'error': 'not found'}, status=404)
+
+    def _send_json(self, payload, status=200):
+        body = dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _auth(self, _):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        token = {'access_token': 'benchmark', 'refresh_token': 'benchmark', 'user': {'id': 1}}
+        self._send_json({**token, 'response': token})
+
+    def _illust(self, illust_id):
+        settings = self.server.settings
+        base = f'{self.server.url}/img/{illust_id}'
+        illust = {
+            'id': illust_id,
+            'title': f'illust {illust_id}',
+            'type': 'illust',
+            'user': {'id': 1, 'name': 'benchmark'},
+            'meta_single_page': {},
+            'meta_pages': [],
+        }
+        if settings.ugoira_every and illust_id % settings.ugoira_every == 0:
+            illust['type'] = 'ugoira'
+        elif settings.pages_per_illust == 1:
+            illust['meta_single_page'] = {'original_image_url': f'{base}_p0.jpg'}
+            illust['image_urls'] = {'large': f'{base}_p0_master1200.jpg'}
+        else:
+            illust['meta_pages'] = [
+                {'image_urls': {'original': f'{base}_p{idx}.jpg', 'large': f'{base}_p{idx}_master1200.jpg'}}
+                for idx in range(settings.pages_per_illust)
+            ]
+
+        return illust
+
+    def _illust_page(self, start, next_url):
+        settings = self.server.settings
+        # Ids count down from the newest illust like the real listings.
+        illust_ids = range(settings.illusts - start, max(settings.illusts - start - PAGE_SIZE, 0), -1)
+        has_next = start + PAGE_SIZE < settings.illusts
+        self._send_json({
+            'illusts': [self._illust(illust_id) for illust_id in illust_ids],
+            'next_url': next_url(start + PAGE_SIZE) if has_next else None,
+        })
+
+    def _bookmarks(self, query):
+        user_id = query.get('user_id')
+        start = self.server.settings.illusts - int(query.get('max_bookmark_id') or self.server.settings.illusts)
+        self._illust_page(start, lambda offset: (
+            f'{self.server.url}/v1/user/bookmarks/illust?user_id={user_id}&restrict=public'
+            f'&max_bookmark_id={self.server.settings.illusts - offset}'))
+
+    def _user_illusts(self, query):
+        user_id = query.get('user_id')
+        self._illust_page(int(query.get('offset') or 0), lambda offset: (
+            f'{self.server.url}/v1/user/illusts?user_id={user_id}&filter=for_ios&type=illust&offset={offset}'))
+
+    def _ugoira_metadata(self, query):
+        self._send_json({'ugoira_metadata': {
+            'zip_urls': {'medium': f'{self.server.url}/img/{query["illust_id"]}_ugoira600x600.zip'},
+            'frames': self.server.ugoira_frames,
+        }})
+
+    def _list_creator(self, query):
+        settings = self.server.settings
+        page = int(query.get('page') or 0)
+        post_ids = range(settings.posts - page * FANBOX_PAGE_SIZE,
+                         max(settings.posts - (page + 1) * FANBOX_PAGE_SIZE, 0), -1)
+        has_next = (page + 1) * FANBOX_PAGE_SIZE < settings.posts
+        self._send_json({'body': {
+            'items': [
+                {'id': str(post_id), 'title': f'post {post_id}', 'publishedDatetime': '2025-01-01T00:00:00+09:00'}
+                for post_id in post_ids
+            ],
+            'nextUrl': f'{self.server.url}/post.listCreator?creatorId={query.get("creatorId")}&page={page + 1}'
+            if has_next else None,
+        }})
+
+    def _post_info(self, query):
+        post_id = query['postId']
+        images = [
+            {'originalUrl': f'{self.server.url}/img/fanbox{post_id}_{idx}.jpg'}
+            for idx in range(self.server.settings.images_per_post)
+        ]
+        self._send_json({'body': {'body': {'images': images}}})
+
+    def _send_file(self, path):
+        body = self.server.ugoira_zip if path.endswith('.zip') else self.server.file_body(path)
+        start = 0
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            start = int(byte_range.split('=')[1].split('-')[0])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+
+        end = len(body)
+        if self.server.random_chance(self.server.settings.truncate_rate):
+            end = start + (end - start) // 2
+            self.close_connection = True
+
+        self._write_throttled(memoryview(body)[start:end])
+
+    def _write_throttled(self, body):
+        bandwidth = self.server.settings.bandwidth
+        started = perf_counter()
+        for offset in range(0, len(body), WRITE_CHUNK):
+            self.wfile.write(body[offset:offset + WRITE_CHUNK])
+            if bandwidth:
+                ahead = (offset + WRITE_CHUNK) / bandwidth - (perf_counter() - started)
+                if ahead > 0:
+                    sleep(ahead)
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the pixiv app API, the image CDN and the fanbox API.
+
+    Every file gets distinct bytes, so deduplication does not flatter the numbers. Ugoira
+    zips are real JPEG sequences so the encode stage does its normal work.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, settings=None, port=0):
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.settings = settings or MockSettings()
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.ugoira_zip, self.ugoira_frames = _ugoira_zip()
+        self._noise = Random(self.settings.seed).randbytes(self.settings.image_size + 4096)
+        self._random = Random(self.settings.seed)
+        self._thread = None
+
+    def handle_error(self, request, client_address):
+        # Clients drop idle keep-alive connections when they exit, that is not worth a traceback.
+        if not isinstance(exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def random_chance(self, rate):
+        return rate and self._random.random() < rate
+
+    def file_body(self, path):
+        # A per-file header in front of shared noise keeps files distinct without generating them.
+        return sha256(path.encode()).digest() * 128 + self._noise[:self.settings.image_size]
+
+    def __enter__(self):
+        self._thread = Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Serve the mock pixiv / fanbox endpoints until interrupted.')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    mock_settings = MockSettings(latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate)
+    with MockServer(mock_settings, args.port) as server:
+        print(f'Mock server listening on {server.url}')
+        server._thread.join()
@@ -0,0 +1,245 @@
+from concurrent.futures import Future
+from functools import partial
+from os import remove
+from os.path import basename, exists, getsize
+from sys import argv
+
+from loguru import logger
+
+from config import DOWNLOAD_CONFIG
+from database import MAX_SQL_VARIABLES, db_lock, get_db
+from dir_index import mark_removed
+from metrics import metrics
+
+# Tables recording whole illusts, reopened by ``reopen_skipped``.
+ILLUST_TABLES = ('downloaded_illusts', 'downloaded_by')
+# Where a page landed and, for pages fetched in the bandwidth saver's 'large' size, the original still to fetch.
+PATH_COLUMNS = ('path text', 'original_url text', 'original_path text')
+
+_initialized = False
+
+
+def init_page_manifest():
+    global _initialized
+    with db_lock:
+        if _initialized:
+            return
+
+        get_db().execute(
+            """
+            create table if not exists illust_pages (
+                illust_id integer,
+                page_index integer,
+                url text,
+                size integer,
+                status varchar(10),
+                path text,
+                original_url text,
+                original_path text,
+                primary key (illust_id, page_index)
+            )
+            """
+        )
+        columns = [column[1] for column in get_db().execute('pragma table_info(illust_pages)')]
+        for column in PATH_COLUMNS:
+            if column.split()[0] not in columns:
+                get_db().execute(f'alter table illust_pages add column {column}')
+
+        get_db().commit()
+        _initialized = True
+
+
+def finished_pages(illust_ids):
+    """The ``(illust_id, page_index)`` pairs of ``illust_ids`` already downloaded, in either size."""
+    init_page_manifest()
+    illust_ids = [int(illust_id) for illust_id in illust_ids]
+    finished = set()
+    with metrics.timer('db'), db_lock:
+        for start in range(0, len(illust_ids), MAX_SQL_VARIABLES):
+            chunk = illust_ids[start:start + MAX_SQL_VARIABLES]
+            finished.update(get_db().execute(
+                f"""
+                select illust_id, page_index from illust_pages
+                where status in ('done', 'large') and illust_id in ({', '.join('?' * len(chunk))})
+                """,
+                chunk
+            ).fetchall())
+
+    metrics.add('skipped_known_pages', len(finished))
+    return finished
+
+
+def max_pages():
+    return DOWNLOAD_CONFIG['MAX_PAGES_PER_ILLUST'] or float('inf')
+
+
+def _page_done(illust_id, page_index, url, upgrade, future):
+    if future.cancelled() or future.exception() is not None:
+        return
+
+    path = future.result()
+    original_url, original_path = upgrade or (None, None)
+    with db_lock, get_db():
+        get_db().execute(
+            'insert or replace into illust_pages values (?, ?, ?, ?, ?, ?, ?, ?)',
+            (illust_id, page_index, url, getsize(path), 'large' if upgrade else 'done', path, original_url,
+             original_path)
+        )
+
+
+def track(illust_id, pages):
+    """
+    Record the downloads of one illust's ``(page_index, url, future, upgrade)`` pages as pending.
+
+    Each page is marked done with its size as soon as its own future finishes, so an
+    interrupted run resumes a long manga at the first missing page. ``upgrade`` is the
+    ``(original_url, original_path)`` of a page fetched in the 'large' size, None for
+    originals. Queued jobs are left out, the job queue keeps track of those itself.
+    """
+    pages = [page for page in pages if isinstance(page[2], Future)]
+    if not pages:
+        return
+
+    init_page_manifest()
+    with metrics.timer('db'), db_lock, get_db():
+        # A page finishing before this insert already has its 'done' row, which is kept.
+        get_db().executemany(
+            "insert or ignore into illust_pages (illust_id, page_index, url, status) values (?, ?, ?, 'pending')",
+            [(illust_id, page_index, url) for page_index, url, _, _ in pages]
+        )
+
+    for page_index, url, future, upgrade in pages:
+        future.add_done_callback(partial(_page_done, illust_id, page_index, url, upgrade))
+
+
+def skip_pages(illust_id, pages):
+    """Record the ``(page_index, url)`` pages left out by ``MAX_PAGES_PER_ILLUST``."""
+    if not pages:
+        return
+
+    init_page_manifest()
+    logger.warning(
+        f'{illust_id} has {len(pages)} pages beyond MAX_PAGES_PER_ILLUST, they are recorded as skipped '
+        f'and can be fetched later with "python page_manifest.py reopen".')
+    metrics.add('skipped_pages', len(pages))
+    with db_lock, get_db():
+        get_db().executemany(
+            "insert or ignore into illust_pages (illust_id, page_index, url, status) values (?, ?, ?, 'skipped')",
+            [(illust_id, page_index, url) for page_index, url in pages]
+        )
+
+
+def _forget_illusts(db, illust_ids, tables):
+    for table in tables:
+        if db.execute("select 1 from sqlite_master where type = 'table' and name = ?", (table,)).fetchone():
+            db.executemany(f'delete from {table} where illust_id = ?', [(illust_id,) for illust_id in illust_ids])
+
+
+def reopen_skipped():
+    """
+    Forget the illusts that had pages skipped, so the next full rescan fetches their remaining pages.
+
+    Meant for after raising ``MAX_PAGES_PER_ILLUST``; pages already downloaded are not fetched again.
+    """
+    init_page_manifest()
+    with db_lock, get_db():
+        db = get_db()
+        illust_ids = [row[0] for row in db.execute(
+            "select distinct illust_id from illust_pages where status = 'skipped'")]
+        _forget_illusts(db, illust_ids, ILLUST_TABLES)
+        db.execute("delete from illust_pages where status = 'skipped'")
+
+    logger.success(f'Reopened {len(illust_ids)} illusts, run the downloads with --full-rescan to fetch them.')
+    return illust_ids
+
+
+def pages_at(paths):
+    """The ``(illust_id, page_index)`` of each of ``paths`` the manifest knows about."""
+    init_page_manifest()
+    pages = {}
+    with db_lock:
+        for start in range(0, len(paths), MAX_SQL_VARIABLES):
+            chunk = paths[start:start + MAX_SQL_VARIABLES]
+            pages.update(
+                (path, (illust_id, page_index)) for path, illust_id, page_index in get_db().execute(
+                    f"""
+                    select path, illust_id, page_index from illust_pages
+                    where path in ({', '.join('?' * len(chunk))})
+                    """,
+                    chunk
+                )
+            )
+
+    return pages
+
+
+def reopen_page(illust_id, page_index=None, tables=ILLUST_TABLES):
+    """Forget one page of an illust and the illust itself, so the next full rescan fetches the page again."""
+    init_page_manifest()
+    with db_lock, get_db():
+        _forget_illusts(get_db(), [illust_id], tables)
+        get_db().execute('delete from illust_pages where illust_id = ? and page_index = ?', (illust_id, page_index))
+
+
+def _upgraded(illust_id, page_index, large_path, future):
+    if future.cancelled() or future.exception() is not None:
+        return
+
+    original_path = future.result()
+    if large_path != original_path and exists(large_path):
+        remove(large_path)
+        mark_removed(large_path)
+
+    with db_lock, get_db():
+        get_db().execute(
+            """
+            update illust_pages
+            set url = original_url, path = original_path, size = ?, status = 'done',
+                original_url = null, original_path = null
+            where illust_id = ? and page_index = ?
+            """,
+            (getsize(original_path), illust_id, page_index)
+        )
+
+
+def upgrade_large_pages(pool):
+    """
+    Fetch the originals of the pages the bandwidth saver fetched in the 'large' size.
+
+    They go into ``pool`` in the 'upgrade' class, behind every sync download, and each
+    smaller copy is removed once its original is on disk. Returns the upgrade futures.
+    """
+    init_page_manifest()
+    with db_lock:
+        rows = get_db().execute(
+            "select illust_id, page_index, path, original_url, original_path from illust_pages where status = 'large'"
+        ).fetchall()
+
+    futures = []
+    for illust_id, page_index, path, original_url, original_path in rows:
+        future = pool.submit(original_url, original_path, basename(original_path), priority='upgrade')
+        future.add_done_callback(partial(_upgraded, illust_id, page_index, path))
+        futures.append(future)
+
+    if futures:
+        logger.info(f'Upgrading {len(futures)} pages fetched in the large size to their originals.')
+
+    return futures
+
+
+if __name__ == '__main__':
+    # python page_manifest.py [reopen | upgrade]
+    if argv[1:] == ['reopen']:
+        reopen_skipped()
+    elif argv[1:] == ['upgrade']:
+        from downloader import DownloadPool, wait_all
+
+        with DownloadPool() as download_pool:
+            upgrades = upgrade_large_pages(download_pool)
+
+        exit(0 if wait_all(upgrades) else 1)
+    else:
+        init_page_manifest()
+        for status, illusts, pages in get_db().execute(
+                'select status, count(distinct illust_id), count(*) from illust_pages group by status'):
+            print(f'{status:<10}{illusts:>8} illusts{pages:>10} pages')
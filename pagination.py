@@ -0,0 +1,244 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+from loguru import logger
+
+from api_cache import cached_call
+from bandwidth import saver_url
+from database import insert_rows, select_existing_ids
+from downloader import wait_all
+from job_queue import enqueue
+from metrics import metrics
+from page_manifest import finished_pages, max_pages, skip_pages, track
+from rate_limiter import ApiError
+
+# Pause when no sync fetched a page in a full round, i.e. all of them only wait on downloads.
+IDLE_WAIT = 0.1
+# Page sizes to fall back through, best first; single page illusts only list ``original_image_url``.
+PAGE_SIZES = ('original_image_url', 'original', 'large', 'medium', 'square_medium')
+
+
+def iter_pages(first_page, fetch_next, parse_qs, max_pages, stop=None):
+    """
+    Yield ``(json_result, next_query)`` for up to ``max_pages`` API pages.
+
+    The next page is requested on a background thread as soon as the current one is
+    yielded, so its metadata arrives while the caller is still downloading files. Paging
+    ends early once ``stop(json_result)`` returns True for a page.
+    """
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='api-prefetch') as prefetcher:
+        json_result = first_page
+        for page_count in range(1, max_pages + 1):
+            next_query = parse_qs(json_result.next_url)
+            if stop is not None and stop(json_result):
+                next_query = None
+
+            upcoming = None
+            if next_query and page_count < max_pages:
+                upcoming = prefetcher.submit(cached_call, fetch_next, **next_query)
+
+            yield json_result, next_query
+
+            if upcoming is None:
+                return
+
+            json_result = upcoming.result()
+
+
+def run_interleaved(syncs):
+    """
+    Step several page-by-page syncs round robin until all of them are done.
+
+    ``syncs`` maps a name to a generator that yields True after each API page and False
+    while it only waits on its last downloads. Every sync's requests go through the same
+    token bucket, so interleaving them keeps the API busy at the global rate instead of
+    paying each user's pages one after another. A sync that raises is logged and dropped
+    while the others go on; the names of those are returned.
+    """
+    active = dict(syncs)
+    failed = []
+    try:
+        while active:
+            fetched = False
+            for name, sync in list(active.items()):
+                try:
+                    fetched = next(sync) or fetched
+                except StopIteration:
+                    del active[name]
+                except Exception as err:
+                    logger.exception(f'Syncing {name} failed: {err!r}')
+                    failed.append(name)
+                    del active[name]
+
+            if active and not fetched:
+                sleep(IDLE_WAIT)
+    finally:
+        for sync in active.values():
+            sync.close()
+
+    return failed
+
+
+def illust_row(result):
+    """The row recording a downloaded illust in ``downloaded_by`` or ``downloaded_illusts``."""
+    return result.id, result.type, result.user.name
+
+
+def save_finished_illusts(table, pending_illusts, failed_ids, wait=False):
+    """
+    Record the illusts whose downloads and encodes have all finished in ``table``.
+
+    Illusts still in flight are returned unless ``wait`` is set, so a slow ugoira encode
+    does not hold up the next page. Ids of illusts with a failed download are added to
+    ``failed_ids``.
+    """
+    finished = []
+    in_flight = []
+    for result, futures in pending_illusts:
+        if not wait and not all(future.done() for future in futures):
+            in_flight.append((result, futures))
+        elif wait_all(futures):
+            finished.append(illust_row(result))
+        else:
+            logger.warning(f'Not all pages of {result.id} were downloaded, it will be retried next run.')
+            failed_ids.add(result.id)
+
+    if finished:
+        logger.debug(f'Saving image ids {[row[0] for row in finished]}')
+        insert_rows(table, finished)
+
+    return in_flight
+
+
+def _queue_pages(result, done_pages, download_page, original_path, use_queue=False):
+    pages = []
+    skipped_pages = []
+    for page_index, page in enumerate(result.meta_pages or [result.meta_single_page]):
+        urls = page['image_urls'] if 'image_urls' in page else page
+        image_url = next((urls[size] for size in PAGE_SIZES if size in urls), None)
+        if image_url is None:
+            continue
+
+        if page_index >= max_pages():
+            skipped_pages.append((page_index, image_url))
+            continue
+        if (result.id, page_index) in done_pages:
+            continue
+
+        # Queued jobs are not tracked in the page manifest, so a smaller copy would never be upgraded.
+        fetched_url = image_url if use_queue else saver_url(result, urls) or image_url
+        future = download_page(result, fetched_url)
+        if future is not None:
+            upgrade = None if fetched_url == image_url else (image_url, original_path(result, image_url))
+            pages.append((page_index, fetched_url, future, upgrade))
+
+    track(result.id, pages)
+    skip_pages(result.id, skipped_pages)
+    return [future for _, _, future, _ in pages]
+
+
+def queue_illusts(api, illusts, failed_ids, table, download_page, original_path, download_ugoira, use_queue=False):
+    """
+    Start the downloads of every illust of one API page not yet in ``table``, returning ``(result, futures)`` pairs.
+
+    The scripts only decide where files go. ``download_page(result, image_url)`` and
+    ``download_ugoira(result, ugoira_metadata)`` submit one file and return its future, or
+    None when it is already on disk; ``original_path(result, original_url)`` is where the
+    original of a page fetched in the saver's 'large' size goes. Pages past
+    ``MAX_PAGES_PER_ILLUST`` are recorded as skipped and pages already downloaded are left
+    out. A ugoira whose metadata is unavailable is added to ``failed_ids``.
+    """
+    queued_illusts = []
+    downloaded_ids = select_existing_ids(table, 'illust_id', (result.id for result in illusts))
+    done_pages = finished_pages(result.id for result in illusts if result.id not in downloaded_ids)
+    for result in illusts:
+        if result.id in downloaded_ids:
+            logger.debug(f'Database check is already downloaded {result.id}')
+            continue
+
+        if result.type != 'ugoira':
+            futures = _queue_pages(result, done_pages, download_page, original_path, use_queue)
+        else:
+            try:
+                ugoira_data = cached_call(api.ugoira_metadata, result.id)
+            except ApiError as err:
+                # Held like a failed download, so the mark never moves past it while it is unavailable.
+                logger.warning(f'Skipping ugoira {result.id}, its metadata is unavailable: {err}')
+                metrics.add('unavailable_illusts')
+                failed_ids.add(result.id)
+                continue
+
+            future = download_ugoira(result, ugoira_data.ugoira_metadata)
+            futures = [] if future is None else [future]
+
+        queued_illusts.append((result, futures))
+
+    return queued_illusts
+
+
+class _Page:
+    """An API page whose illusts are being downloaded, and the query of the page after it."""
+
+    def __init__(self, next_query):
+        self.next_query = next_query
+        self.pending_illusts = []
+        self.failed_ids = set()
+
+
+def sync_illusts(state, table, first_page, fetch_next, parse_qs, max_pages, queue_page, label, cursor_key,
+                 use_queue=False):
+    """
+    The page loop shared by the artist and bookmark syncs, a generator for ``run_interleaved``.
+
+    ``queue_page(illusts, failed_ids)`` starts the downloads of one API page and returns its
+    ``(result, futures)`` pairs, adding the ids of illusts it cannot start to ``failed_ids``;
+    the illusts are recorded in ``table`` once those finish, or handed to the job queue with
+    ``use_queue``. Each page is logged as ``label`` and the ``cursor_key`` of its next page
+    query. Yields True after each page and False while only waiting on the last downloads.
+    The cursor is checkpointed past the newest page whose illusts, and those of every page
+    before it, are all recorded, so it never moves past an illust that failed. ``state`` is
+    committed at the end.
+    """
+    pages = deque()
+    last_query = None
+
+    def record_pages(wait=False):
+        for page in pages:
+            if page.pending_illusts:
+                page.pending_illusts = save_finished_illusts(table, page.pending_illusts, page.failed_ids, wait)
+
+        # A page with a failed illust stays at the front, so the next run fetches it again.
+        recorded = []
+        while pages and not pages[0].pending_illusts and not pages[0].failed_ids:
+            recorded.append(pages.popleft())
+
+        if recorded:
+            state.checkpoint(recorded[-1].next_query)
+
+    try:
+        for json_result, next_query in iter_pages(
+                first_page, fetch_next, parse_qs, max_pages,
+                stop=lambda page: state.observe(illust.id for illust in page.illusts)):
+            logger.info(f'{label}: {next_query.get(cursor_key, "last_page") if next_query else "last_page"}')
+            page = _Page(next_query)
+            queued_illusts = queue_page(json_result.illusts, page.failed_ids)
+            if use_queue:
+                # The queue workers record each illust once its jobs are acked.
+                enqueue(table, [(illust_row(result), jobs) for result, jobs in queued_illusts])
+            else:
+                page.pending_illusts = queued_illusts
+
+            pages.append(page)
+            last_query = next_query
+            record_pages()
+            yield True
+
+        while any(page.pending_illusts for page in pages):
+            yield False
+            record_pages()
+    finally:
+        # Whatever finished is recorded even when paging failed.
+        record_pages(wait=True)
+
+    state.commit(complete=last_query is None and not any(page.failed_ids for page in pages))
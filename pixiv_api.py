@@ -0,0 +1,13 @@
+from config import API_CONFIG, REFRESH_TOKEN, RETRY_CONFIG
+
+
+def create_api():
+    """An authenticated app API client, talking to ``APP_API_HOST`` instead of pixiv when it is set."""
+    from pixivpy3 import AppPixivAPI
+
+    api = AppPixivAPI(timeout=RETRY_CONFIG['TIMEOUT'])
+    if API_CONFIG['APP_API_HOST']:
+        api.hosts = API_CONFIG['APP_API_HOST']
+
+    api.auth(refresh_token=REFRESH_TOKEN)
+    return api
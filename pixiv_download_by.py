@@ -1,214 +1,177 @@
-from os import getcwd, mkdir, walk, remove
-from os.path import exists, abspath, join
-from random import uniform
+from argparse import ArgumentParser
+from os import getcwd, makedirs
 from re import match
-from sqlite3 import connect
-from time import sleep
+from sys import platform
 from traceback import print_exc
-from zipfile import ZipFile
 
-import requests
 from loguru import logger
 from pathvalidate import sanitize_filename
-from pixivpy3 import AppPixivAPI
-from win10toast import ToastNotifier
 
-from config import REFRESH_TOKEN
+from api_cache import cached_call
+from bandwidth import saver_active
+from config import UGOIRA_CONFIG
+from database import init_id_table
+from dir_index import path_exists
+from job_queue import open_pools
+from pagination import queue_illusts, run_interleaved, sync_illusts
+from metrics import write_summary
+from page_manifest import upgrade_large_pages
+from pixiv_api import create_api
+from retry import report_retries
+from sync_state import SyncState
+from ugoira import output_path_for
 
 USER_ID = 5657723
 
 MAX_ITER_COUNT = 50
+# Class of these downloads in BANDWIDTH_CONFIG['PRIORITIES'].
+DOWNLOAD_PRIORITY = 'by'
 
-img_db = connect('./pixiv_id_db.db')
 
+def root_path_for(user_id):
+    return f'{getcwd()}/data/pixivPic/{user_id}'
 
-def _get_root_path():
-    supposed_path = f'{getcwd()}/data/pixivPic/{USER_ID}'
-    if not exists(supposed_path):
-        mkdir(supposed_path)
 
-    return supposed_path
+ROOT_PATH = root_path_for(USER_ID)
 
 
-ROOT_PATH = _get_root_path()
+def image_path(image_url, root_path=ROOT_PATH):
+    file_name = image_url.split('/')[-1]
 
+    path = f'{root_path}/{file_name}'.replace('\\\\', '/')
+    if not match(r'.*?\.[jpgnif]{3,4}$', path):
+        path += '.jpg'
 
-def save_img_id(img_id, img_type, illuster):
-    img_id = str(img_id)
-    logger.debug(f'Saving image id {img_id}')
-    img_db.execute(
-        """
-        insert or replace into downloaded_by values (?, ?, ?)
-        """, (img_id, img_type, illuster)
-    )
-    img_db.commit()
-
-
-def check_database_already_downloaded(img_id):
-    img_id = str(img_id)
-    info = img_db.execute(
-        """
-        select illust_id from downloaded_by where illust_id = ?
-        """, (img_id,)
-    ).fetchone()
-
-    return info
-
-
-def download(url, path, title):
-    with requests.get(url, stream=True, headers={'Referer': 'https://app-api.pixiv.net/'}) as r:
-        total_size = len(r.content) if r.headers.get('content-length') is None else int(r.headers.get('content-length'))
-        written_size = 0
-        r.raise_for_status()
-        with open(path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                written_size += len(chunk)
-                f.write(chunk)
-                print(f'Downloading {title}:  {written_size / total_size * 100:.1f}%',
-                      end='\r' if written_size < total_size or written_size / total_size > 1.1 else '\n',
-                      flush=True)
-
-    logger.success(f'Download done {path}.')
     return path
 
 
-def download_image(image_url, title):
+def download_image(pool, image_url, title, root_path=ROOT_PATH):
     title = sanitize_filename(title)
 
     if image_url is None:
         logger.info('Image url is none somehow!!')
     else:
-        file_name = image_url.split('/')[-1]
-
-        path = f'{ROOT_PATH}/{file_name}'.replace('\\\\', '/')
-        if not match(r'.*?\.[jpgnif]{3,4}$', path):
-            path += '.jpg'
-        if not exists(path):
-            download(image_url, path, title)
+        path = image_path(image_url, root_path)
+        if not path_exists(path):
+            return pool.submit(image_url, path, title, priority=DOWNLOAD_PRIORITY)
 
+    return None
 
-def get_absolute_file_paths(directory):
-    file_paths = []
-    for folder, subs, files in walk(directory):
-        for filename in files:
-            file_paths.append(abspath(join(folder, filename)))
 
-    return file_paths
-
-
-def download_gif(ugoira_url, title, result_id):
+def download_gif(pool, encoder, ugoira_url, title, frames, result_id, root_path=ROOT_PATH):
     if ugoira_url is None:
         logger.warning('Zip ugoira is None!!!')
-        return
+        return None
 
     title = sanitize_filename(title)
 
     file_name = ugoira_url.split('/')[-1]
-    gif_zip_path = f'{ROOT_PATH}/{file_name}'.replace('\\\\', '/')
+    gif_zip_path = f'{root_path}/{file_name}'.replace('\\\\', '/')
+
+    return download_gif_processor(pool, encoder, gif_zip_path, ugoira_url, title, frames, result_id)
 
-    download_gif_processor(gif_zip_path, ugoira_url, title, result_id)
 
+def download_gif_processor(pool, encoder, gif_zip_path, ugoira_url, title, frames, result_id):
+    fmt = UGOIRA_CONFIG['BY_USER_FORMAT']
+    output_path = output_path_for(gif_zip_path, fmt)
+    if path_exists(output_path):
+        return None
 
-def download_gif_processor(gif_zip_path, ugoira_url, title, result_id):
-    if not exists(gif_zip_path):
-        path = download(ugoira_url, gif_zip_path, title)
-        gif_zip_path_path = gif_zip_path.split('.')[0]
-        with ZipFile(path, 'r') as zipref:
-            if not exists(gif_zip_path_path):
-                mkdir(gif_zip_path_path)
-                for idx, zipinfo in enumerate(zipref.infolist()):
-                    zipinfo.filename = f'{result_id}_p{idx}.jpg'
-                    zipref.extract(zipinfo, path=gif_zip_path_path)
+    if path_exists(gif_zip_path):
+        return encoder.submit(gif_zip_path, output_path, frames, fmt, frame_prefix=result_id)
 
-        remove(gif_zip_path)
+    download_future = pool.submit(ugoira_url, gif_zip_path, title, priority=DOWNLOAD_PRIORITY)
+    return encoder.submit(gif_zip_path, output_path, frames, fmt, after=download_future, frame_prefix=result_id)
 
 
 def _init_database():
-    img_db.execute(
-        """
-        create table if not exists downloaded_by (
-            illust_id varchar(20) unique on conflict ignore,
-            type varchar(20),
-            illustrator varchar(100)
-        )
-        """
-    )
-
-
-def main():
-    iter_count = 0
-    api = AppPixivAPI()
-    api.auth(refresh_token=REFRESH_TOKEN)
-
-    json_result = api.user_illusts(user_id=USER_ID)
-    # json_result = api.user_bookmarks_illust(user_id=USER_ID, req_auth=True, filter=None)
-    next_query = {}
-    while next_query is not None and MAX_ITER_COUNT > iter_count:
-        logger.info(
-            f'Fetching data: {next_query["offset"] if "offset" in next_query else "current_page"}')
-        for result in json_result.illusts:
-            illust_data = []
-            title = result.title
-            if check_database_already_downloaded(result.id):
-                logger.debug(f'Database check is already downloaded {result.id}')
-                continue
-
-            if result.type != 'ugoira':
-                if result.meta_pages:
-                    illust_data = result.meta_pages
-                else:
-                    illust_data.append(result.meta_single_page)
-
-                if len(illust_data) > 50:
-                    illust_data = illust_data[:50]
-                for illust in illust_data:
-                    image_url = None
-                    if 'image_urls' in illust:
-                        illust = illust['image_urls']
-                        if 'original' in illust:
-                            image_url = illust['original']
-                        elif 'large' in illust:
-                            image_url = illust['large']
-                        elif 'medium' in illust:
-                            image_url = illust['medium']
-                        elif 'square_medium' in illust:
-                            image_url = illust['square_medium']
-                    else:
-                        if 'original_image_url' in illust:
-                            image_url = illust['original_image_url']
-                        else:
-                            continue
-
-                    download_image(image_url, title + '_' + image_url.split('_')[-1])
-            else:
-                ugoira_data = api.ugoira_metadata(result.id)
-                url_list = ugoira_data.ugoira_metadata.zip_urls.medium
-                download_gif(url_list, title, result.id)
-
-            save_img_id(result.id, result.type, result.user.name)
-
-        next_query = api.parse_qs(json_result.next_url)
-        if next_query:
-            json_result = api.user_illusts(**next_query)
-            rand_sleep_time = uniform(2.0, 4.0)
-            logger.info(f'Sleeping for {rand_sleep_time:.1f}s')
-            sleep(rand_sleep_time)
-            iter_count += 1
-        else:
-            break
+    init_id_table('downloaded_by', 'illust_id', 'type varchar(20), illustrator varchar(100)')
+
+
+def _queue_page(api, pool, encoder, illusts, failed_ids, root_path=ROOT_PATH, use_queue=False):
+    """Start the downloads of every not yet downloaded illust of one API page."""
+    return queue_illusts(
+        api, illusts, failed_ids, 'downloaded_by',
+        lambda result, image_url: download_image(
+            pool, image_url, result.title + '_' + image_url.split('_')[-1], root_path),
+        lambda result, original_url: image_path(original_url, root_path),
+        lambda result, metadata: download_gif(
+            pool, encoder, metadata.zip_urls.medium, result.title, metadata.frames, result.id, root_path),
+        use_queue)
+
+
+def sync_user(api, encoder, pool, user_id=USER_ID, full_rescan=False, use_queue=False):
+    """
+    Sync the illusts of ``user_id`` one API page at a time.
+
+    Yields True after each page and False while only waiting on the last downloads, so
+    ``run_interleaved`` can fetch other users' pages in between. Any number of users can
+    share ``api`` and the two pools.
+    """
+    root_path = root_path_for(user_id)
+    makedirs(root_path, exist_ok=True)
+
+    state = SyncState(f'by:{user_id}', full_rescan, ordered=True)
+    next_query = state.load_cursor(full_rescan)
+    if next_query:
+        json_result = cached_call(api.user_illusts, **next_query)
+    else:
+        json_result = cached_call(api.user_illusts, user_id=user_id)
+
+    yield from sync_illusts(
+        state, 'downloaded_by', json_result, api.user_illusts, api.parse_qs, MAX_ITER_COUNT,
+        lambda illusts, failed_ids: _queue_page(api, pool, encoder, illusts, failed_ids, root_path, use_queue),
+        f'Fetching data of {user_id}', 'offset', use_queue)
+
+
+def main(full_rescan=False, use_queue=False):
+    _init_database()
+    api = create_api()
+
+    try:
+        with open_pools(use_queue) as (encoder, pool):
+            failed = run_interleaved({
+                f'by:{USER_ID}': sync_user(api, encoder, pool, USER_ID, full_rescan, use_queue),
+            })
+            if not use_queue and not saver_active():
+                upgrade_large_pages(pool)
+    finally:
+        write_summary('by')
+
+    pool.report()
+    report_retries()
+    if failed:
+        raise RuntimeError(f'Syncing the illusts of {USER_ID} failed.')
 
 
 def wrapping_up(text: str):
+    # The toast is a Windows nicety, cron runs elsewhere only get the log line.
+    if platform != 'win32':
+        logger.info(text)
+        return
+
+    from win10toast import ToastNotifier
+
     toast = ToastNotifier()
     toast.show_toast("PixivDownloadBy APP", text, duration=1)
 
 
-if __name__ == '__main__':
-    _init_database()
+def run(full_rescan=False, use_queue=False):
     try:
-        main()
+        main(full_rescan=full_rescan, use_queue=use_queue)
         wrapping_up('Download done with no issue!!')
     except Exception as err:
         wrapping_up(f'Something happened, see error for details! {err.__traceback__}')
         print_exc()
-        exit(-1)
+        return -1
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Download every illust of USER_ID.')
+    parser.add_argument('--full-rescan', action='store_true',
+                        help='ignore the high-water mark and page through the whole listing')
+    parser.add_argument('--queue', action='store_true', help='only crawl, queueing the downloads for the job_queue workers')
+    args = parser.parse_args()
+    exit(run(full_rescan=args.full_rescan, use_queue=args.queue))
@@ -0,0 +1,66 @@
+from argparse import ArgumentParser
+
+
+def main(argv=None):
+    """
+    One entry point for the three sync modes, the multi-user scheduler and the queue workers.
+
+    Only the selected mode's module is imported, so a cron run pays for the dependencies it
+    actually uses.
+    """
+    parser = ArgumentParser(description='Sync pixiv bookmarks, the illusts of one artist or fanbox creators.')
+    modes = parser.add_subparsers(dest='mode', required=True)
+    modes.add_parser('bookmark', help='download the bookmarks of pixiv_download_bookmark.USER_ID')
+    modes.add_parser('by', help='download every illust of pixiv_download_by.USER_ID')
+    fanbox = modes.add_parser('fanbox', help='download the posts of fanbox creators')
+    fanbox.add_argument('--creator', action='append', dest='creators',
+                        help='creator id to sync, can be repeated; defaults to FANBOX_CONFIG')
+    fanbox.add_argument('--async-fetch', action='store_true',
+                        help='fetch post metadata concurrently and download through a worker pool')
+    schedule = modes.add_parser('schedule', help='sync several artists and bookmark owners in one process')
+    schedule.add_argument('--by', action='append', type=int, dest='by_users',
+                          help='artist whose illusts to sync, can be repeated; defaults to SCHEDULE_CONFIG')
+    schedule.add_argument('--bookmark', action='append', type=int, dest='bookmark_users',
+                          help='account whose bookmarks to sync, can be repeated; defaults to SCHEDULE_CONFIG')
+    for mode in modes.choices.values():
+        mode.add_argument('--full-rescan', action='store_true',
+                          help='ignore the high-water mark and go through the whole listing')
+        mode.add_argument('--queue', action='store_true',
+                          help='only crawl, queueing the downloads for the job_queue workers')
+
+    work = modes.add_parser('work', help='download the jobs queued by --queue crawls')
+    work.add_argument('--processes', type=int, help='worker processes, defaults to QUEUE_CONFIG')
+    work.add_argument('--follow', action='store_true', help='keep polling for new jobs instead of exiting')
+
+    args = parser.parse_args(argv)
+    if args.mode == 'work':
+        from job_queue import work as drain_queue
+
+        return drain_queue(args.processes, args.follow)
+
+    if args.mode == 'schedule':
+        from scheduler import sync_users
+
+        if args.by_users or args.bookmark_users:
+            args.by_users, args.bookmark_users = args.by_users or [], args.bookmark_users or []
+
+        return -1 if sync_users(args.by_users, args.bookmark_users, args.full_rescan, args.queue) else 0
+
+    if args.mode == 'bookmark':
+        from pixiv_download_bookmark import main as sync_bookmarks
+
+        sync_bookmarks(full_rescan=args.full_rescan, use_queue=args.queue)
+        return 0
+
+    if args.mode == 'by':
+        from pixiv_download_by import run
+
+        return run(full_rescan=args.full_rescan, use_queue=args.queue)
+
+    from pixivfanbox import pixivfanbox_batch
+
+    return -1 if pixivfanbox_batch(args.creators, args.full_rescan, args.async_fetch, args.queue) else 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -1,17 +1,22 @@
-from os import mkdir
-from os.path import exists, isdir
+from argparse import ArgumentParser
+from asyncio import Semaphore, as_completed, create_task, gather, run, wrap_future
+from collections import deque
+from contextlib import nullcontext
+from os import makedirs
 from sys import stderr
-from typing import Union
 
-from cfscrape import create_scraper
-from httpx import Client
 from loguru import logger
 from pathvalidate import sanitize_filename
-from requests import exceptions
-from urllib3.exceptions import ProtocolError
 
-from config import FANBOX_CONFIG
-from pixiv_download_bookmark import img_db
+from config import FANBOX_CONFIG, RETRY_CONFIG
+from database import init_id_table, insert_rows, select_existing_ids
+from dir_index import path_exists
+from downloader import DownloadPool, download, wait_all
+from job_queue import QueuedDownloads, enqueue
+from http_session import share_pool
+from metrics import metrics, write_summary
+from retry import api_retry, download_retry, report_retries
+from sync_state import SyncState
 
 logger_format = (
     "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
@@ -26,8 +31,14 @@ WHITE_LIST_DRAWER = FANBOX_CONFIG['WHITE_LIST_DRAWER']
 BLACKLIST_WORDS = FANBOX_CONFIG['BLACKLIST_WORDS']
 LIMIT = FANBOX_CONFIG['LIMIT_TO_FETCH']
 DATE = FANBOX_CONFIG['MAX_DATE']
+MIN_DATE = FANBOX_CONFIG['MIN_DATE']
 
 CREATOR = FANBOX_CONFIG['PIXIV_CREATOR_CONFIG']
+CREATORS = FANBOX_CONFIG['CREATORS'] or [CREATOR]
+
+FANBOX_API = FANBOX_CONFIG['API_BASE']
+# Class of these downloads in BANDWIDTH_CONFIG['PRIORITIES'].
+DOWNLOAD_PRIORITY = 'fanbox'
 
 HEADERS = {
     'cookie': FANBOX_CONFIG['SESSION_ID'],
@@ -35,8 +46,6 @@ HEADERS = {
                   'AppleWebKit/537.36 (KHTML, like Gecko) '
                   'Chrome/92.0.4515.159 Safari/537.36',
     "authority": 'api.fanbox.cc',
-    "path": f'/post.listCreator?creatorId={CREATOR}&maxPublishedDatetime={DATE}%2004%3A16%3A39'
-            f'&maxId={"9" * 12}&limit={LIMIT}',
     "accept": 'application/json, text/plain, */*',
     "origin": 'https://www.fanbox.cc',
     "referer": 'https://www.fanbox.cc/'
@@ -44,71 +53,35 @@ HEADERS = {
 
 
 def _init_database():
-    img_db.execute("""
-        create table if not exists fanbox (
-            post_id varchar(50) unique on conflict ignore,
-            creator_name varchar(200),
-            title varchar(255),
-            no_access boolean
-        )
-    """)
-    img_db.commit()
-
+    init_id_table('fanbox', 'post_id', 'creator_name varchar(200), title varchar(255), no_access boolean')
 
-def _check_if_post_id_exists(post_id: Union[int, str]):
-    post_id = str(post_id)
-    result = img_db.execute(
-        """
-        select * from fanbox where post_id = ?
-        """, (post_id,)
-    ).fetchone()
 
-    return result is not None
+def _get_existing_post_ids(post_ids):
+    return select_existing_ids('fanbox', 'post_id', post_ids)
 
 
-def _insert_to_db(post_id: str, creator_name: str, title: str, no_access=False):
-    img_db.execute(
-        """
-        insert or replace into fanbox values (?, ?, ?, ?)
-        """, (post_id, creator_name, title, no_access)
-    )
-    img_db.commit()
+def _insert_to_db(finished_posts):
+    insert_rows('fanbox', finished_posts)
 
 
 def _file_name_from_url(file_name: str):
     return sanitize_filename(file_name)
 
 
-def image_download(scraper, original_image_url, file_name):
-    try:
-        page = scraper.get(original_image_url, headers=HEADERS, stream=True)
-    except ConnectionError or exceptions.ConnectionError:
-        logger.warning('Connection aborted, retrying...')
-        image_download(scraper, original_image_url, file_name)
-        return
+def _image_path(creator, file_name):
+    return f'./data/image/{creator}/{file_name}'
 
-    data_downloaded = 0
-    with open(f'./data/image/{CREATOR}/{file_name}', 'wb+') as file:
-        if 'Content-Length' in page.headers:
-            total = int(page.headers["Content-Length"])
-        else:
-            total = -1
-        for chunk in page.iter_content(chunk_size=1024 ** 2):
-            if total > 0:
-                data_downloaded += len(chunk)
-                print(
-                    f'Downloaded "{file_name}": {data_downloaded / total * 100:.2f}%',
-                    flush=True,
-                    end='\r' if data_downloaded < total else '\n'
-                )
-            if chunk:
-                file.write(chunk)
 
+def image_download(original_image_url, creator, file_name):
+    download_retry.call(
+        download, original_image_url, _image_path(creator, file_name), file_name, headers=HEADERS,
+        priority=DOWNLOAD_PRIORITY)
     logger.success(f'Downloading of image {file_name} completed.')
 
 
-def _download_fanbox_files(scraper, data_body):
+def _fanbox_file_downloads(data_body):
     data_body = data_body['files'] if 'files' in data_body else data_body['fileMap']
+    downloads = []
     for count, file in enumerate(data_body):
         if isinstance(file, str):
             file = data_body[file]
@@ -116,111 +89,380 @@ def _download_fanbox_files(scraper, data_body):
         original_image_url = file['url']
         file_name = title + '.' + original_image_url.split('.')[-1]
 
-        file_name = _file_name_from_url(file_name)
+        downloads.append((original_image_url, _file_name_from_url(file_name)))
+
+    return downloads
+
+
+def _fanbox_image_downloads(data, creator, title, data_body):
+    if 'images' not in data_body:
+        images_enable = False
+    else:
+        images_enable = True
+
+    images = data_body['images'] if 'images' in data_body else data_body['imageMap']
+    downloads = []
+    count = 0
+    for image in images:
+        if not images_enable:
+            image = images[image]
+
+        original_image = image['originalUrl']
+        original_image_url = original_image.replace('\\', '')
+
+        count += 1
+        if creator not in WHITE_LIST_DRAWER:
+            file_name = title + f'{count:04d}' + '.' + original_image_url.split('.')[-1]
+        else:
+            file_name = title + data['id'] + f'{count:04d}' + '.' + original_image_url.split('.')[-1]
+
+        downloads.append((original_image_url, _file_name_from_url(file_name)))
+
+    return downloads
+
+
+def _post_title(data):
+    title = data["title"] if "title" in data else "?"
+    for word in BLACKLIST_WORDS:
+        title = title.replace(word, '').strip()
+
+    return title
 
-        if exists(f'data/image/{CREATOR}/{file_name}'):
+
+def _post_downloads(data, creator, title, page):
+    """
+    Work out what one ``post.info`` response needs downloaded.
+
+    Returns ``(no_access, [(url, file_name), ...])``, leaving out files already on disk.
+    """
+    data_body = page['body']
+    if data_body is None:
+        return False, []
+
+    logger.info(f'title: {title}')
+    logger.info(f'Link: https://www.fanbox.cc/@{creator}/posts/{data["id"]}')
+    logger.info(f'Published time: {data["publishedDatetime"]}')
+
+    data_body = data_body['body']
+    if data_body is None:
+        return True, []
+
+    downloads = []
+    if 'files' in data_body or 'fileMap' in data_body:
+        downloads += _fanbox_file_downloads(data_body)
+
+    if ('images' in data_body and data_body['images']) or ('imageMap' in data_body and data_body['imageMap']):
+        downloads += _fanbox_image_downloads(data, creator, title, data_body)
+
+    missing = []
+    for url, file_name in downloads:
+        if path_exists(_image_path(creator, file_name)):
             logger.info(f'File: {file_name} exists. Skipping...')
             continue
 
-        image_download(scraper, original_image_url, file_name)
+        missing.append((url, file_name))
 
+    return False, missing
+
+
+def _init_creator_directory(creator):
+    makedirs(f'data/image/{creator}', exist_ok=True)
+
+
+def _get_json(scraper, url):
+    with metrics.timer('api'):
+        response = scraper.get(url, headers=HEADERS, timeout=RETRY_CONFIG['TIMEOUT'])
+        response.raise_for_status()
+        return response.json()
+
+
+async def _get_json_async(client, url):
+    with metrics.timer('api'):
+        response = await client.get(url)
+        response.raise_for_status()
+        return response.json()
 
-def pixivfanbox_crawler():
-    _init_database()
-    session = Client()
-    session.headers = HEADERS
-    scraper = create_scraper(sess=session)
-    page = scraper.get(
-        f'https://api.fanbox.cc/post.listCreator?creatorId={CREATOR}&maxPublishedDatetime='
-        f'{DATE}%2005%3A13%3A17&maxId=2514720&limit={LIMIT}', headers=HEADERS
-    )
 
-    json_data = page.json()
-    json_data = json_data['body']['items']
-    logger.debug(f'data count: {len(json_data)}')
+def _first_listing_url(creator):
+    url = f'{FANBOX_API}/post.listCreator?creatorId={creator}&limit={LIMIT}'
+    if DATE:
+        url += f'&maxPublishedDatetime={DATE}%2005%3A13%3A17&maxId={"9" * 12}'
 
-    if not isdir(f'data/image'):
-        mkdir('data/image')
+    return url
 
-    if not isdir(f'data/image/{CREATOR}'):
-        mkdir(f'data/image/{CREATOR}')
 
-    for data in json_data:
+def _listing_page(body, state):
+    posts = body['items']
+    next_url = body.get('nextUrl')
+    logger.debug(f'data count: {len(posts)}')
+
+    if state.observe(data['id'] for data in posts):
+        next_url = None
+
+    if MIN_DATE and any(data['publishedDatetime'][:10] < MIN_DATE for data in posts):
+        posts = [data for data in posts if data['publishedDatetime'][:10] >= MIN_DATE]
+        next_url = None
+
+    return posts, next_url
+
+
+def iter_listing_pages(scraper, creator, state, full_rescan=False):
+    """
+    Stream ``post.listCreator`` page by page, yielding ``(posts, next_url)``.
+
+    Starts at the page an interrupted crawl stopped at, if any, and follows ``nextUrl`` until
+    the listing is exhausted, the high-water mark is reached or posts get older than
+    ``MIN_DATE``. The yielded ``next_url`` is None on the last page.
+    """
+    url = state.load_cursor(full_rescan) or _first_listing_url(creator)
+    while url:
+        posts, next_url = _listing_page(api_retry.call(_get_json, scraper, url)['body'], state)
+        yield posts, next_url
+        url = next_url
+
+
+async def _iter_listing_pages_async(client, creator, state, full_rescan=False):
+    """``iter_listing_pages`` over the crawl's ``AsyncClient``."""
+    url = state.load_cursor(full_rescan) or _first_listing_url(creator)
+    while url:
+        posts, next_url = _listing_page((await api_retry.call_async(_get_json_async, client, url))['body'], state)
+        yield posts, next_url
+        url = next_url
+
+
+def _new_posts(posts, state):
+    new_posts = []
+    existing_post_ids = _get_existing_post_ids(data['id'] for data in posts)
+    for data in posts:
         post_id = data['id']
-        if _check_if_post_id_exists(post_id):
+        # Listed by publish time, so a post drafted long ago can still come after a newer id.
+        if state.mark is not None and int(post_id) == state.mark:
+            logger.info(f'Reached the already synced post {post_id}, stopping.')
+            break
+
+        if int(post_id) in existing_post_ids:
             logger.info(f'post id: {post_id} already exists, skipping the fetch.')
             continue
 
-        try:
-            page = scraper.get(f'https://api.fanbox.cc/post.info?postId={post_id}', headers=HEADERS).json()
-        except ProtocolError or ConnectionError:
-            logger.error('Protocol error encountered, retrying the whole process now.')
-            pixivfanbox_crawler()
-            return
+        new_posts.append(data)
 
-        data_body = page['body']
+    return new_posts
 
-        title = data["title"] if "title" in data else "?"
-        for word in BLACKLIST_WORDS:
-            title = title.replace(word, '').strip()
 
-        if data_body is None:
-            _insert_to_db(post_id, CREATOR, title)
-            continue
+def _create_scraper():
+    from cfscrape import create_scraper
 
-        logger.info(f'title: {title}')
-        logger.info(f'Link: https://www.fanbox.cc/@{CREATOR}/posts/{data["id"]}')
-        logger.info(f'Published time: {data["publishedDatetime"]}')
+    scraper = share_pool(create_scraper())
+    scraper.headers.update(HEADERS)
+    return scraper
 
-        data_body = data_body['body']
 
-        if data_body is None:
-            _insert_to_db(post_id, CREATOR, title, True)
-            continue
+def pixivfanbox_crawler(full_rescan=False, creator=CREATOR, scraper=None):
+    _init_database()
+    _init_creator_directory(creator)
+    scraper = scraper or _create_scraper()
+    state = SyncState(f'fanbox:{creator}', full_rescan, ordered=False)
 
-        if ('images' not in data_body or not data_body['images']) \
-                and ('imageMap' not in data_body or not data_body['imageMap']):
-            if 'files' in data_body or 'fileMap' in data_body:
-                _download_fanbox_files(scraper, data_body)
+    next_url = None
+    for posts, next_url in iter_listing_pages(scraper, creator, state, full_rescan):
+        finished_posts = []
+        try:
+            for data in _new_posts(posts, state):
+                post_id = data['id']
+                page = api_retry.call(_get_json, scraper, f'{FANBOX_API}/post.info?postId={post_id}')
+                title = _post_title(data)
+                no_access, downloads = _post_downloads(data, creator, title, page)
+                for original_image_url, file_name in downloads:
+                    image_download(original_image_url, creator, file_name)
 
-            _insert_to_db(post_id, CREATOR, title)
-            continue
+                finished_posts.append((int(post_id), creator, title, no_access))
+        finally:
+            # Posts finished before a request gave up are kept, the rest of the page is retried next run.
+            _insert_to_db(finished_posts)
 
-        if 'files' in data_body or 'fileMap' in data_body:
-            _download_fanbox_files(scraper, data_body)
+        state.checkpoint(next_url)
 
-        if 'images' not in data_body:
-            images_enable = False
-        else:
-            images_enable = True
+    state.commit(complete=next_url is None)
+    logger.success(f'All tasks of {creator} completed without problem.')
+
+
+async def _iter_post_infos(client, semaphore, posts):
+    """Fetch ``post.info`` for all ``posts`` concurrently, yielding ``(post, response)`` as each one arrives."""
+    from httpx import HTTPError
+
+    async def fetch_once(data):
+        async with semaphore:
+            return await _get_json_async(client, f'{FANBOX_API}/post.info?postId={data["id"]}')
+
+    async def fetch(data):
+        return data, await api_retry.call_async(fetch_once, data)
 
-        images = data_body['images'] if 'images' in data_body else data_body['imageMap']
-        count = 0
-        for image in images:
-            if not images_enable:
-                image = images[image]
+    for next_done in as_completed([fetch(data) for data in posts]):
+        try:
+            yield await next_done
+        except (HTTPError, ValueError) as err:
+            logger.error(f'Fetching post info failed: {err!r}')
+            yield None, None
 
-            original_image = image['originalUrl']
-            original_image_url = original_image.replace('\\', '')
 
-            count += 1
-            if CREATOR not in WHITE_LIST_DRAWER:
-                file_name = title + f'{count:04d}' + '.' + original_image_url.split('.')[-1]
-            else:
-                file_name = title + data['id'] + f'{count:04d}' + '.' + original_image_url.split('.')[-1]
+async def _queue_posts(client, semaphore, pool, creator, posts):
+    queued_posts = []
+    async for data, page in _iter_post_infos(client, semaphore, posts):
+        if data is None:
+            continue
 
-            file_name = _file_name_from_url(file_name)
+        title = _post_title(data)
+        no_access, downloads = _post_downloads(data, creator, title, page)
+        futures = [
+            pool.submit(url, _image_path(creator, file_name), file_name, headers=HEADERS, priority=DOWNLOAD_PRIORITY)
+            for url, file_name in downloads
+        ]
+        queued_posts.append(((int(data['id']), creator, title, no_access), futures))
 
-            if exists(f'data/image/{CREATOR}/{file_name}'):
-                logger.info(f'File: {file_name} exists. Skipping...')
-                continue
+    return queued_posts
 
-            image_download(scraper, original_image_url, file_name)
 
-        _insert_to_db(post_id, CREATOR, title)
+def _save_finished_posts(queued_posts):
+    finished_posts = []
+    for row, futures in queued_posts:
+        if wait_all(futures):
+            finished_posts.append(row)
+        else:
+            logger.warning(f'Not all files of post {row[0]} were downloaded, it will be retried next run.')
+
+    _insert_to_db(finished_posts)
+    return len(finished_posts)
+
+
+async def _crawl_async(scraper, creator, state, pool, full_rescan=False, use_queue=False):
+    """
+    Page through the listing and fetch ``post.info`` on one event loop and one ``AsyncClient``.
+
+    Listing pages are fetched ahead while earlier pages' posts are still being looked up, so
+    ``POST_INFO_CONCURRENCY`` requests stay in flight even with small pages. Pages are
+    finished (recorded or queued, then checkpointed) strictly in listing order. Returns
+    whether every post of the listing made it.
+    """
+    from httpx import AsyncClient, Timeout
+
+    concurrency = FANBOX_CONFIG['POST_INFO_CONCURRENCY']
+    semaphore = Semaphore(concurrency)
+    # Enough unfinished pages to fill every post.info slot, plus the one waiting on its downloads.
+    max_pages_ahead = -(-concurrency // max(LIMIT, 1)) + 1
+    pages = deque()
+    complete = True
+    next_url = None
+
+    async def finish_oldest_page():
+        nonlocal complete
+        new_posts, page_next_url, queuing = pages.popleft()
+        queued_posts = await queuing
+        if use_queue:
+            # Posts whose post.info failed were not queued, they hold the cursor and the mark like failed downloads.
+            enqueue('fanbox', queued_posts)
+            complete = len(queued_posts) == len(new_posts) and complete
+        else:
+            futures = [future for _, post_futures in queued_posts for future in post_futures]
+            await gather(*(wrap_future(future) for future in futures), return_exceptions=True)
+            complete = _save_finished_posts(queued_posts) == len(new_posts) and complete
 
-    logger.success('All tasks completed without problem.')
+        if complete:
+            state.checkpoint(page_next_url)
+
+    connect_timeout, read_timeout = RETRY_CONFIG['TIMEOUT']
+    timeout = Timeout(read_timeout, connect=connect_timeout)
+    async with AsyncClient(headers=HEADERS, cookies=dict(scraper.cookies), timeout=timeout) as client:
+        try:
+            async for posts, next_url in _iter_listing_pages_async(client, creator, state, full_rescan):
+                new_posts = _new_posts(posts, state)
+                pages.append((new_posts, next_url, create_task(_queue_posts(client, semaphore, pool, creator, new_posts))))
+                if len(pages) >= max_pages_ahead:
+                    await finish_oldest_page()
+        finally:
+            # Pages already listed are finished even when paging failed, like in the synchronous crawler.
+            while pages:
+                await finish_oldest_page()
+
+    return complete and next_url is None
+
+
+def pixivfanbox_crawler_async(full_rescan=False, creator=CREATOR, scraper=None, pool=None, use_queue=False):
+    """
+    Same sync as ``pixivfanbox_crawler``, but ``post.info`` is fetched for many posts at once.
+
+    Each post's files go into a shared ``DownloadPool`` as soon as its metadata arrives, so
+    metadata latency overlaps with file transfers. A post is recorded once all of its
+    downloads finished. With ``use_queue`` the files are queued for the job_queue workers
+    instead, which record the post themselves.
+    """
+    _init_database()
+    _init_creator_directory(creator)
+    scraper = scraper or _create_scraper()
+    state = SyncState(f'fanbox:{creator}', full_rescan, ordered=False)
+
+    if pool is None:
+        pool = QueuedDownloads() if use_queue else DownloadPool()
+        owns_pool = True
+    else:
+        owns_pool = False
+
+    with pool if owns_pool else nullcontext(pool) as download_pool:
+        complete = run(_crawl_async(scraper, creator, state, download_pool, full_rescan, use_queue))
+
+    if owns_pool:
+        download_pool.report()
+
+    state.commit(complete=complete)
+    logger.success(f'All tasks of {creator} completed without problem.')
+
+
+def pixivfanbox_batch(creators=None, full_rescan=False, async_fetch=False, use_queue=False):
+    """
+    Sync several creators in one process.
+
+    They share the cloudflare scraper session, the DB connection and, in async mode, the
+    download pool, so the handshakes are paid once rather than once per creator. Queueing
+    goes through the async crawler, the synchronous one downloads inline.
+    """
+    creators = creators or CREATORS
+    scraper = _create_scraper()
+    failed_creators = []
+    async_fetch = async_fetch or use_queue
+    # Only the async crawler downloads through a pool, the synchronous one fetches each file inline.
+    pool = (QueuedDownloads() if use_queue else DownloadPool()) if async_fetch else None
+    with nullcontext() if pool is None else pool:
+        for creator in creators:
+            logger.info(f'Syncing fanbox creator {creator}...')
+            try:
+                if async_fetch:
+                    pixivfanbox_crawler_async(full_rescan, creator, scraper, pool, use_queue)
+                else:
+                    pixivfanbox_crawler(full_rescan, creator, scraper)
+            except Exception as err:
+                logger.exception(f'Syncing {creator} failed: {err!r}')
+                failed_creators.append(creator)
+
+    if pool is not None:
+        pool.report()
+
+    report_retries()
+    write_summary('fanbox')
+
+    if failed_creators:
+        logger.error(f'Failed creators: {failed_creators}')
+
+    return failed_creators
 
 
 if __name__ == '__main__':
-    pixivfanbox_crawler()
+    parser = ArgumentParser(description='Download the posts of the configured fanbox creators.')
+    parser.add_argument('--full-rescan', action='store_true',
+                        help='ignore the high-water mark and go through the whole listing')
+    parser.add_argument('--async-fetch', action='store_true',
+                        help='fetch post metadata concurrently and download through a worker pool')
+    parser.add_argument('--creator', action='append', dest='creators',
+                        help='creator id to sync, can be repeated; defaults to FANBOX_CONFIG')
+    parser.add_argument('--queue', action='store_true', help='only crawl, queueing the downloads for the job_queue workers')
+    args = parser.parse_args()
+    if pixivfanbox_batch(args.creators, args.full_rescan, args.async_fetch, args.queue):
+        exit(-1)
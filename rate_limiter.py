@@ -0,0 +1,78 @@
+from threading import Lock
+from time import monotonic, sleep
+
+from loguru import logger
+
+from config import API_CONFIG
+from metrics import metrics
+from retry import TransientError, api_retry
+
+# Error payloads that retrying does not fix mention one of these: deleted, missing or private works.
+PERMANENT_API_ERRORS = ('deleted', 'does not exist', 'not found', 'limited who can view', '削除', '存在しない')
+
+
+class ApiError(Exception):
+    """An error payload that retrying does not fix, e.g. for a deleted or private work."""
+
+
+class TokenBucket:
+    """
+    Classic token bucket: ``rate`` tokens are added per second up to ``capacity``.
+
+    ``acquire`` blocks only as long as needed for enough tokens to be available, so bursts
+    after idle periods go through immediately while the long-run rate stays bounded.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+
+                wait_time = (tokens - self._tokens) / self.rate
+
+            sleep(wait_time)
+            waited += wait_time
+
+
+api_limiter = TokenBucket(API_CONFIG['REQUESTS_PER_SECOND'], API_CONFIG['BURST'])
+
+
+def _limited_call(func, *args, **kwargs):
+    waited = api_limiter.acquire()
+    if waited:
+        metrics.observe('rate_limit_wait', waited)
+        logger.debug(f'Rate limited API call for {waited:.1f}s')
+
+    with metrics.timer('api'):
+        result = func(*args, **kwargs)
+
+    # pixivpy hands back error responses (rate limits, 5xx, 404s) as an ``error`` object without the status,
+    # so anything not known to be permanent is retried.
+    if isinstance(result, dict) and result.get('error'):
+        if any(phrase in str(result['error']).lower() for phrase in PERMANENT_API_ERRORS):
+            raise ApiError(f'pixiv API error: {result["error"]}')
+
+        raise TransientError(f'pixiv API error: {result["error"]}')
+
+    return result
+
+
+def rate_limited(func, *args, **kwargs):
+    """Call an API function once the shared API token bucket allows it, retrying transient failures."""
+    return api_retry.call(_limited_call, func, *args, **kwargs)
@@ -0,0 +1,136 @@
+from asyncio import sleep as async_sleep
+from random import uniform
+from sys import modules
+from threading import Lock
+from time import perf_counter, sleep
+
+import requests
+from loguru import logger
+from urllib3.exceptions import ProtocolError, TimeoutError as Urllib3TimeoutError
+
+from config import RETRY_CONFIG
+from metrics import metrics
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TransientError(IOError):
+    """A failure worth retrying that no transport library reports as such, e.g. a truncated body."""
+
+
+def is_transient(err):
+    """
+    Whether ``err`` (or an exception it was raised from) is a network hiccup or a retryable status.
+
+    pixivpy wraps every transport error in a ``PixivError``, so the exception chain is walked.
+    Downloads read the raw urllib3 stream, so its timeouts are not wrapped by requests either.
+    """
+    transient_errors = (TransientError, ConnectionError, TimeoutError, ProtocolError, Urllib3TimeoutError,
+                        requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+    status_errors = (requests.HTTPError,)
+    # httpx is only imported for HTTP/2 and async fetches, without it none of its errors can occur.
+    httpx = modules.get('httpx')
+    if httpx is not None:
+        transient_errors += (httpx.TransportError,)
+        status_errors += (httpx.HTTPStatusError,)
+
+    while err is not None:
+        if isinstance(err, transient_errors):
+            return True
+
+        response = getattr(err, 'response', None)
+        if isinstance(err, status_errors) and response is not None:
+            return response.status_code in RETRY_STATUSES
+
+        err = err.__cause__ or err.__context__
+
+    return False
+
+
+class Retry:
+    """
+    Retry policy for one kind of request, with exponential backoff and full jitter.
+
+    Only the failing request is repeated, never the crawl around it. ``calls``, ``retries``,
+    ``failures`` and the seconds spent on failed attempts and backoff are kept for ``report``.
+    """
+
+    def __init__(self, name, max_attempts=None, base_delay=None, max_delay=None):
+        self.name = name
+        self.max_attempts = max_attempts or RETRY_CONFIG['MAX_ATTEMPTS']
+        self.base_delay = base_delay or RETRY_CONFIG['BASE_DELAY']
+        self.max_delay = max_delay or RETRY_CONFIG['MAX_DELAY']
+
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.retry_seconds = 0.0
+        self._lock = Lock()
+
+    def _backoff(self, attempt):
+        return uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _failed(self, err, attempt, started):
+        """Record a failed attempt and return how long to wait before the next one, or raise."""
+        transient = is_transient(err)
+        with self._lock:
+            self.retry_seconds += perf_counter() - started
+            if not transient or attempt + 1 >= self.max_attempts:
+                self.failures += 1
+                metrics.add('request_failures')
+                if transient:
+                    logger.error(f'{self.name} failed after {self.max_attempts} attempts: {err!r}')
+
+                raise err
+
+            self.retries += 1
+            metrics.add('retries')
+
+        delay = self._backoff(attempt)
+        logger.warning(f'{self.name} failed ({err!r}), retrying in {delay:.1f}s...')
+        with self._lock:
+            self.retry_seconds += delay
+
+        metrics.observe('retry_backoff', delay)
+
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        with self._lock:
+            self.calls += 1
+
+        for attempt in range(self.max_attempts):
+            started = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                sleep(self._failed(err, attempt, started))
+
+    async def call_async(self, func, *args, **kwargs):
+        """Same as ``call`` for a coroutine function, backing off without blocking the event loop."""
+        with self._lock:
+            self.calls += 1
+
+        for attempt in range(self.max_attempts):
+            started = perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception as err:
+                await async_sleep(self._failed(err, attempt, started))
+
+    def report(self):
+        if not self.retries and not self.failures:
+            return
+
+        logger.info(
+            f'{self.name}: {self.calls} requests, {self.retries} retries, {self.failures} failed, '
+            f'{self.retry_seconds:.1f}s lost to failed attempts and backoff')
+
+
+api_retry = Retry('API request')
+download_retry = Retry('Download')
+
+
+def report_retries():
+    api_retry.report()
+    download_retry.report()
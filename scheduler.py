@@ -0,0 +1,76 @@
+from argparse import ArgumentParser
+from os import makedirs
+
+from loguru import logger
+
+import pixiv_download_bookmark
+import pixiv_download_by
+from bandwidth import saver_active
+from config import SCHEDULE_CONFIG
+from job_queue import open_pools
+from metrics import write_summary
+from page_manifest import upgrade_large_pages
+from pagination import run_interleaved
+from pixiv_api import create_api
+from retry import report_retries
+
+
+def sync_users(by_users=None, bookmark_users=None, full_rescan=False, use_queue=False):
+    """
+    Sync the illusts of several artists and the bookmarks of several accounts in one process.
+
+    One authenticated API client and one pair of download / encode pools serve every user,
+    and their pages are interleaved under the global rate limit, so the run is bounded by
+    bandwidth rather than by the number of users. Returns the syncs that failed.
+    """
+    by_users = by_users if by_users is not None else SCHEDULE_CONFIG['BY_USERS']
+    bookmark_users = bookmark_users if bookmark_users is not None else SCHEDULE_CONFIG['BOOKMARK_USERS']
+    pixiv_download_by._init_database()
+    pixiv_download_bookmark._init_database()
+    makedirs(pixiv_download_bookmark.ROOT_PATH, exist_ok=True)
+    api = create_api()
+
+    try:
+        with open_pools(use_queue) as (encoder, pool):
+            syncs = {
+                f'by:{user_id}': pixiv_download_by.sync_user(api, encoder, pool, user_id, full_rescan, use_queue)
+                for user_id in by_users
+            }
+            syncs.update({
+                f'bookmark:{user_id}': pixiv_download_bookmark.sync_user(
+                    api, encoder, pool, user_id, full_rescan, use_queue)
+                for user_id in bookmark_users
+            })
+            logger.info(f'Syncing {len(syncs)} users...')
+            failed = run_interleaved(syncs)
+            if not use_queue and not saver_active():
+                # Originals of the pages fetched in the large size during the saver hours.
+                upgrade_large_pages(pool)
+    finally:
+        write_summary('schedule')
+
+    pool.report()
+    report_retries()
+    if failed:
+        logger.error(f'Failed syncs: {failed}')
+
+    return failed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Sync several pixiv artists and bookmark owners in one process.')
+    parser.add_argument('--by', action='append', type=int, dest='by_users',
+                        help='artist whose illusts to sync, can be repeated; defaults to SCHEDULE_CONFIG')
+    parser.add_argument('--bookmark', action='append', type=int, dest='bookmark_users',
+                        help='account whose bookmarks to sync, can be repeated; defaults to SCHEDULE_CONFIG')
+    parser.add_argument('--full-rescan', action='store_true',
+                        help='ignore the high-water marks and page through the whole listings')
+    parser.add_argument('--queue', action='store_true',
+                        help='only crawl, queueing the downloads for the job_queue workers')
+    args = parser.parse_args()
+    if args.by_users or args.bookmark_users:
+        # Users given on the command line replace the configured ones altogether.
+        args.by_users, args.bookmark_users = args.by_users or [], args.bookmark_users or []
+
+    if sync_users(args.by_users, args.bookmark_users, args.full_rescan, args.queue):
+        exit(-1)
@@ -0,0 +1,137 @@
+from json import dumps, loads
+
+from loguru import logger
+
+from database import db_lock, get_db
+
+
+def init_sync_state():
+    with db_lock, get_db():
+        get_db().execute(
+            """
+            create table if not exists sync_state (
+                source varchar(100) primary key,
+                high_water integer
+            )
+            """
+        )
+        get_db().execute(
+            """
+            create table if not exists crawl_cursor (
+                source varchar(100) primary key,
+                next_query text,
+                pending_high_water integer
+            )
+            """
+        )
+
+
+def get_high_water(source):
+    with db_lock:
+        row = get_db().execute('select high_water from sync_state where source = ?', (source,)).fetchone()
+
+    return row[0] if row else None
+
+
+def set_high_water(source, high_water):
+    with db_lock, get_db():
+        get_db().execute(
+            """
+            insert into sync_state (source, high_water) values (?, ?)
+            on conflict (source) do update set high_water = excluded.high_water
+            """, (source, high_water)
+        )
+
+
+def load_cursor(source):
+    with db_lock:
+        row = get_db().execute(
+            'select next_query, pending_high_water from crawl_cursor where source = ?', (source,)
+        ).fetchone()
+
+    return (loads(row[0]), row[1]) if row else None
+
+
+def save_cursor(source, next_query, pending_high_water):
+    with db_lock, get_db():
+        get_db().execute(
+            'insert or replace into crawl_cursor values (?, ?, ?)', (source, dumps(next_query), pending_high_water)
+        )
+
+
+def clear_cursor(source):
+    with db_lock, get_db():
+        get_db().execute('delete from crawl_cursor where source = ?', (source,))
+
+
+class SyncState:
+    """
+    Incremental sync state of one source, e.g. ``bookmark:13839440``.
+
+    The high-water mark is the newest item id already synced.
+
+    Listings come newest first. For ``ordered`` sources (an artist's illusts) ids only decrease
+    down the listing, so any id at or below the mark means everything after it is old.
+    Bookmark listings are ordered by bookmark time and fanbox listings by publish time
+    instead, so there the mark is the first item listed and is only reached once that item
+    itself shows up.
+    """
+
+    def __init__(self, source, full_rescan=False, ordered=True):
+        init_sync_state()
+        self.source = source
+        self.ordered = ordered
+        self.mark = None if full_rescan else get_high_water(source)
+        self.newest = None
+        self.reached = False
+        if self.mark is not None:
+            logger.info(f'Incremental sync of {source}, stopping at id {self.mark}.')
+
+    def load_cursor(self, full_rescan=False):
+        """
+        Return the query of the page an unfinished crawl stopped at, or None to start at the top.
+
+        The newest id seen when that crawl started is restored too, so the mark it eventually
+        commits still covers the pages it fetched before the interruption.
+        """
+        if full_rescan:
+            clear_cursor(self.source)
+            return None
+
+        cursor = load_cursor(self.source)
+        if cursor is None:
+            return None
+
+        next_query, self.newest = cursor
+        logger.info(f'Resuming the unfinished crawl of {self.source} at {next_query}.')
+        return next_query
+
+    def checkpoint(self, next_query):
+        """Persist the query of the next page to fetch; a finished crawl (no next page) clears it."""
+        if next_query:
+            save_cursor(self.source, next_query, self.newest)
+        else:
+            clear_cursor(self.source)
+
+    def observe(self, item_ids):
+        """Note the ids of one listing page, returning True once the mark has been reached."""
+        item_ids = [int(item_id) for item_id in item_ids]
+        if self.newest is None and item_ids:
+            self.newest = max(item_ids) if self.ordered else item_ids[0]
+
+        if self.mark is not None and not self.reached:
+            if self.ordered:
+                self.reached = any(item_id <= self.mark for item_id in item_ids)
+            else:
+                self.reached = self.mark in item_ids
+
+        return self.reached
+
+    def commit(self, complete):
+        """Advance the mark, but only after a run that left no gap between the old mark and the newest item."""
+        if not complete or self.newest is None:
+            logger.info(f'Keeping the high-water mark of {self.source} at {self.mark}.')
+            return
+
+        set_high_water(self.source, self.newest)
+        logger.info(f'High-water mark of {self.source} is now {self.newest}.')
@@ -0,0 +1,283 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+from os import listdir, mkdir, remove, replace
+from os.path import exists, getsize, isdir, splitext
+from shutil import rmtree
+from sys import argv
+from threading import Lock
+from time import perf_counter
+from zipfile import ZipFile
+
+from loguru import logger
+
+from config import UGOIRA_CONFIG
+from dir_index import mark_removed, mark_written
+from metrics import metrics
+
+FORMAT_EXTENSIONS = {
+    'gif': '.gif',
+    'webp': '.webp',
+    'apng': '.png',
+    'frames': '',
+}
+
+
+def output_path_for(zip_path, fmt):
+    """Where the converted ugoira goes: a file next to the zip, or a directory for raw frames."""
+    if fmt not in FORMAT_EXTENSIONS:
+        raise ValueError(f'Unknown ugoira format {fmt!r}, expected one of {list(FORMAT_EXTENSIONS)}')
+
+    return splitext(zip_path)[0] + FORMAT_EXTENSIONS[fmt]
+
+
+def frames_from_zip(zip_path, delay=100):
+    """Frame list for a zip without ``ugoira_metadata``, in archive order with a fixed delay."""
+    with ZipFile(zip_path, 'r') as archive:
+        return [{'file': name, 'delay': delay} for name in sorted(archive.namelist())]
+
+
+def iter_frames(zip_path, frames):
+    """
+    Lazily yield ``(image, delay)`` for each entry of ``ugoira_metadata.frames``.
+
+    Frames are read straight from the zip one at a time and decoded on first use, nothing is
+    extracted to disk.
+    """
+    from PIL import Image
+
+    with ZipFile(zip_path, 'r') as archive:
+        for frame in frames:
+            yield Image.open(BytesIO(archive.read(frame['file']))), frame['delay']
+
+
+def save_gif(frames, gif_path):
+    """
+    Write an endlessly looping GIF from ``(image, delay)`` pairs.
+
+    Each frame is quantized to its own local palette and written out immediately, so memory
+    stays at one decoded frame no matter how long the animation is.
+    """
+    from PIL import Image
+    from PIL.GifImagePlugin import getdata, getheader
+
+    part_path = f'{gif_path}.part'
+    frame_count = 0
+    with open(part_path, 'wb') as fp:
+        for image, delay in frames:
+            frame = image.convert('RGB').quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+            if not frame_count:
+                header, _ = getheader(frame, info={'loop': 0})
+                for block in header:
+                    fp.write(block)
+
+            for block in getdata(frame, duration=delay, include_color_table=True):
+                fp.write(block)
+
+            frame_count += 1
+
+        fp.write(b';')
+
+    if not frame_count:
+        remove(part_path)
+        raise ValueError(f'No frames to write to {gif_path}')
+
+    replace(part_path, gif_path)
+    return frame_count
+
+
+def save_animation(frames, path, pil_format, **params):
+    """
+    Write an animated WebP or APNG through Pillow's ``save_all``.
+
+    Unlike ``save_gif`` this keeps every decoded frame until the encoder finishes, as Pillow
+    collects ``append_images`` up front; the frames themselves are still read lazily.
+    """
+    frames = list(frames)
+    if not frames:
+        raise ValueError(f'No frames to write to {path}')
+
+    part_path = f'{path}.part'
+    images = [image for image, _ in frames]
+    images[0].save(
+        part_path,
+        pil_format,
+        save_all=True,
+        append_images=images[1:],
+        duration=[delay for _, delay in frames],
+        loop=0,
+        **params)
+
+    replace(part_path, path)
+    return len(frames)
+
+
+def save_frames(zip_path, frames, directory, prefix):
+    """Copy the raw frames out of the zip as ``{prefix}_p{index}`` files, without re-encoding."""
+    if not exists(directory):
+        mkdir(directory)
+
+    with ZipFile(zip_path, 'r') as archive:
+        for idx, frame in enumerate(frames):
+            extension = splitext(frame['file'])[1] or '.jpg'
+            with open(f'{directory}/{prefix}_p{idx}{extension}', 'wb') as fp:
+                fp.write(archive.read(frame['file']))
+
+    return len(frames)
+
+
+def encode(zip_path, output_path, frames, fmt, frame_prefix=None):
+    if fmt == 'gif':
+        return save_gif(iter_frames(zip_path, frames), output_path)
+
+    if fmt == 'webp':
+        return save_animation(
+            iter_frames(zip_path, frames),
+            output_path,
+            'WEBP',
+            quality=UGOIRA_CONFIG['WEBP_QUALITY'],
+            method=UGOIRA_CONFIG['WEBP_METHOD'],
+            lossless=UGOIRA_CONFIG['WEBP_LOSSLESS'])
+
+    if fmt == 'apng':
+        return save_animation(
+            iter_frames(zip_path, frames),
+            output_path,
+            'PNG',
+            compress_level=UGOIRA_CONFIG['APNG_COMPRESS_LEVEL'])
+
+    if fmt == 'frames':
+        return save_frames(zip_path, frames, output_path, frame_prefix or splitext(zip_path)[0].split('/')[-1])
+
+    raise ValueError(f'Unknown ugoira format {fmt!r}, expected one of {list(FORMAT_EXTENSIONS)}')
+
+
+def _timed_convert(*args):
+    started = perf_counter()
+    output_path = convert_ugoira(*args)
+    return output_path, perf_counter() - started
+
+
+def convert_ugoira(zip_path, output_path, frames, fmt='gif', frame_prefix=None):
+    logger.info(f'Encoding {zip_path} as {fmt}...')
+    frame_count = encode(zip_path, output_path, frames, fmt, frame_prefix)
+    logger.info(f'Wrote {frame_count} frames to {output_path}, removing zip cache.')
+    remove(zip_path)
+    return output_path
+
+
+def compare_formats(zip_paths, formats=('gif', 'webp', 'apng', 'frames')):
+    """
+    Encode every zip in every format and print the encode time and output size per format.
+
+    The zips are left in place, outputs are written next to them with a ``.compare`` suffix
+    and removed afterwards.
+    """
+    totals = {fmt: [0.0, 0] for fmt in formats}
+    for zip_path in zip_paths:
+        frames = frames_from_zip(zip_path)
+        for fmt in formats:
+            output_path = output_path_for(f'{splitext(zip_path)[0]}.compare.zip', fmt)
+            started = perf_counter()
+            encode(zip_path, output_path, frames, fmt)
+            totals[fmt][0] += perf_counter() - started
+            totals[fmt][1] += _remove_output(output_path)
+
+    source_size = sum(getsize(zip_path) for zip_path in zip_paths)
+    print(f'{len(zip_paths)} ugoira, {source_size / 1024 ** 2:.2f} MB of zips')
+    print(f'{"format":<8}{"seconds":>10}{"MB":>10}{"vs zip":>10}')
+    for fmt, (seconds, size) in totals.items():
+        print(f'{fmt:<8}{seconds:>10.2f}{size / 1024 ** 2:>10.2f}{size / max(source_size, 1):>10.2f}')
+
+    return totals
+
+
+def _remove_output(output_path):
+    if isdir(output_path):
+        size = sum(getsize(f'{output_path}/{name}') for name in listdir(output_path))
+        rmtree(output_path)
+        return size
+
+    size = getsize(output_path)
+    remove(output_path)
+    return size
+
+
+def _index_outcome(future, zip_path, output_path):
+    if not future.cancelled() and future.exception() is None:
+        mark_written(output_path)
+        mark_removed(zip_path)
+
+
+def _copy_outcome(source, target):
+    try:
+        output_path, seconds = source.result()
+    except Exception as err:
+        target.set_exception(err)
+        return
+
+    # Encoder processes have their own metrics, the timing is brought back with the result.
+    metrics.observe('encode', seconds)
+    target.set_result(output_path)
+
+
+class EncodePool:
+    """
+    Process pool for the CPU-bound ugoira conversion.
+
+    ``submit`` can chain the conversion onto the future of the zip download, so the encode
+    starts on another core as soon as the zip is on disk while the caller keeps downloading.
+    An output submitted again while it is being encoded gets the running encode's future.
+    """
+
+    def __init__(self, max_workers=None):
+        self._executor = ProcessPoolExecutor(max_workers=max_workers or UGOIRA_CONFIG['ENCODE_WORKERS'])
+        self._in_flight = {}
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def _finished(self, output_path):
+        with self._lock:
+            del self._in_flight[output_path]
+
+    def submit(self, zip_path, output_path, frames, fmt='gif', after=None, frame_prefix=None):
+        with self._lock:
+            if output_path in self._in_flight:
+                return self._in_flight[output_path]
+
+            encoded = self._in_flight[output_path] = Future()
+
+        encoded.add_done_callback(lambda _: self._finished(output_path))
+        # pixivpy's JsonDict frames are reduced to plain dicts before crossing the process boundary.
+        frames = [{'file': frame['file'], 'delay': frame['delay']} for frame in frames]
+        args = (_timed_convert, zip_path, output_path, frames, fmt, frame_prefix)
+        # The encode runs in another process, so the directory index is updated from here once it is done.
+        encoded.add_done_callback(lambda future: _index_outcome(future, zip_path, output_path))
+        if after is None:
+            self._executor.submit(*args).add_done_callback(lambda future: _copy_outcome(future, encoded))
+            return encoded
+
+        def _encode(download_future):
+            try:
+                download_future.result()
+                encode_future = self._executor.submit(*args)
+            except Exception as err:
+                encoded.set_exception(err)
+                return
+
+            encode_future.add_done_callback(lambda future: _copy_outcome(future, encoded))
+
+        after.add_done_callback(_encode)
+        return encoded
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    # python ugoira.py sample1.zip sample2.zip ...
+    compare_formats(argv[1:])
@@ -0,0 +1,252 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from os import remove, scandir
+from os.path import abspath, splitext
+from re import compile
+from time import time
+from zipfile import BadZipFile, ZipFile
+
+from loguru import logger
+
+from config import VERIFY_CONFIG
+from database import MAX_SQL_VARIABLES, db_lock, get_db
+from dedup import init_content_hash
+from dir_index import mark_removed
+from job_queue import QueuedJob, enqueue, work
+from metrics import metrics, write_summary
+from page_manifest import ILLUST_TABLES, pages_at, reopen_page
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+# Leftovers of interrupted writes, not finished files.
+SKIPPED_SUFFIXES = ('.part', '.len', '.link')
+BATCH_SIZE = 500
+# pixiv_download_by keeps the CDN's file names, which start with the illust id: pixivPic/5657723/81234567_p0.png
+BY_FILE_NAME = compile(r'[/\\]pixivPic[/\\]\d+[/\\](\d+)_(?:p\d+|ugoira)[^/\\]*$')
+
+_initialized = False
+
+
+def init_verified_files():
+    global _initialized
+    with db_lock:
+        if _initialized:
+            return
+
+        get_db().execute(
+            """
+            create table if not exists verified_files (
+                path text primary key,
+                size integer,
+                mtime_ns integer,
+                status varchar(10),
+                checked_at real
+            )
+            """
+        )
+        get_db().commit()
+        _initialized = True
+
+
+def iter_files(root):
+    """Yield ``(path, size, mtime_ns)`` of every finished file under ``root``, statting through ``scandir``."""
+    try:
+        entries = list(scandir(root))
+    except FileNotFoundError:
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_files(entry.path)
+        elif entry.is_file(follow_symlinks=False) and not entry.name.endswith(SKIPPED_SUFFIXES):
+            stat = entry.stat(follow_symlinks=False)
+            yield abspath(entry.path), stat.st_size, stat.st_mtime_ns
+
+
+def check_file(path, size, expected_size):
+    """
+    Runs in the worker processes: return why ``path`` is broken, or None when it reads fine.
+
+    Images are fully decoded, every frame of animated ones included, so a truncated tail is
+    caught; zips have each member's CRC checked.
+    """
+    if expected_size is not None and size != expected_size:
+        return f'size {size} instead of {expected_size}'
+
+    extension = splitext(path)[1].lower()
+    try:
+        if extension in IMAGE_EXTENSIONS:
+            from PIL import Image
+
+            with Image.open(path) as image:
+                for frame in range(getattr(image, 'n_frames', 1)):
+                    image.seek(frame)
+                    image.load()
+        elif extension == '.zip':
+            with ZipFile(path) as zip_file:
+                bad_member = zip_file.testzip()
+                if bad_member is not None:
+                    return f'bad CRC in {bad_member}'
+    except (OSError, SyntaxError, ValueError, BadZipFile, EOFError) as err:
+        return repr(err)
+
+    return None
+
+
+def _check(args):
+    return check_file(*args)
+
+
+def _verified(paths):
+    """The ``(size, mtime_ns)`` each of ``paths`` had when it last verified fine."""
+    verified = {}
+    with db_lock:
+        for start in range(0, len(paths), MAX_SQL_VARIABLES):
+            chunk = paths[start:start + MAX_SQL_VARIABLES]
+            verified.update(
+                (path, (size, mtime_ns)) for path, size, mtime_ns in get_db().execute(
+                    f"""
+                    select path, size, mtime_ns from verified_files
+                    where status = 'ok' and path in ({', '.join('?' * len(chunk))})
+                    """,
+                    chunk
+                )
+            )
+
+    return verified
+
+
+def _recorded(paths):
+    """Size and URL recorded by the downloader for each of ``paths``."""
+    recorded = {}
+    with db_lock:
+        for start in range(0, len(paths), MAX_SQL_VARIABLES):
+            chunk = paths[start:start + MAX_SQL_VARIABLES]
+            recorded.update(
+                (path, (size, url)) for path, size, url in get_db().execute(
+                    f'select path, size, url from content_hash where path in ({", ".join("?" * len(chunk))})', chunk
+                )
+            )
+
+    return recorded
+
+
+def _headers_for(url):
+    if 'fanbox.cc' in url:
+        from pixivfanbox import HEADERS
+
+        return HEADERS
+
+    return None
+
+
+def _requeue(path, url):
+    """Drop a corrupt file and queue it for download again; the next pass checks it anew."""
+    remove(path)
+    mark_removed(path)
+    job = QueuedJob('file', url, path, path, _headers_for(url))
+    enqueue('verified_files', [((path, None, None, 'requeued', time()), [job])])
+
+
+def _owners(paths):
+    """``(tables, illust_id, page_index)`` of the illust each of ``paths`` belongs to, where that can be told."""
+    owners = {path: (ILLUST_TABLES, illust_id, page_index) for path, (illust_id, page_index) in pages_at(paths).items()}
+    for path in paths:
+        found = BY_FILE_NAME.search(path)
+        if path not in owners and found:
+            owners[path] = (('downloaded_by',), int(found[1]), None)
+
+    return owners
+
+
+def _reopen(path, tables, illust_id, page_index):
+    """Drop a corrupt file and forget its illust, so the next full rescan downloads it again."""
+    remove(path)
+    mark_removed(path)
+    reopen_page(illust_id, page_index, tables)
+
+
+def _check_batch(executor, batch, results):
+    recorded = _recorded([path for path, _, _ in batch])
+    checks = [(path, size, recorded.get(path, (None, None))[0]) for path, size, _ in batch]
+    rows = []
+    unknown = []
+    for (path, size, mtime_ns), error in zip(batch, executor.map(_check, checks, chunksize=16)):
+        if error is None:
+            rows.append((path, size, mtime_ns, 'ok', time()))
+            results['ok'] += 1
+            continue
+
+        url = recorded.get(path, (None, None))[1]
+        logger.warning(f'{path} is corrupt: {error}')
+        if url is None:
+            unknown.append((path, size, mtime_ns))
+        else:
+            _requeue(path, url)
+            results['requeued'] += 1
+
+    # Files from before content_hash have no URL, but most can still be traced to their illust.
+    owners = _owners([path for path, _, _ in unknown]) if unknown else {}
+    for path, size, mtime_ns in unknown:
+        if path in owners:
+            _reopen(path, *owners[path])
+            results['reopened'] += 1
+        else:
+            logger.error(f'No download URL or illust is known for {path}, it has to be replaced by hand.')
+            rows.append((path, size, mtime_ns, 'corrupt', time()))
+            results['corrupt'] += 1
+
+    with metrics.timer('db'), db_lock, get_db():
+        get_db().executemany('insert or replace into verified_files values (?, ?, ?, ?, ?)', rows)
+
+
+def verify(roots=None, workers=None, full=False):
+    """
+    Check every file under ``roots`` on a process pool and requeue the corrupt ones.
+
+    Sizes are compared with the length recorded when the file was downloaded, then the
+    content is decoded. Files unchanged since they last passed are skipped unless ``full``
+    is set, so repeated passes over a large archive only read what is new. Corrupt files
+    with a known URL are removed and queued for the job_queue workers. Older ones whose
+    illust is known from the page manifest or the file name are removed and their illust
+    forgotten, so the next ``--full-rescan`` fetches them again; the rest are logged and
+    recorded as corrupt.
+    """
+    init_verified_files()
+    init_content_hash()
+    roots = roots or VERIFY_CONFIG['ROOTS']
+    results = {'ok': 0, 'unchanged': 0, 'corrupt': 0, 'requeued': 0, 'reopened': 0}
+    with ProcessPoolExecutor(max_workers=workers or VERIFY_CONFIG['WORKERS']) as executor:
+        for root in roots:
+            logger.info(f'Verifying {root}...')
+            files = iter_files(root)
+            while batch := [entry for _, entry in zip(range(BATCH_SIZE), files)]:
+                verified = {} if full else _verified([path for path, _, _ in batch])
+                pending = [entry for entry in batch if verified.get(entry[0]) != entry[1:]]
+                results['unchanged'] += len(batch) - len(pending)
+                with metrics.timer('verify'):
+                    _check_batch(executor, pending, results)
+
+    for name, count in results.items():
+        metrics.add(f'verify_{name}', count)
+
+    logger.success(
+        f'Verified {results["ok"]} files, {results["unchanged"]} unchanged since the last pass, '
+        f'{results["requeued"]} requeued, {results["reopened"]} reopened for the next --full-rescan, '
+        f'{results["corrupt"]} corrupt without a known source.')
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Check the downloaded files and requeue the corrupt ones.')
+    parser.add_argument('roots', nargs='*', help='directories to check, defaults to VERIFY_CONFIG')
+    parser.add_argument('--workers', type=int, help='checker processes, one per CPU core by default')
+    parser.add_argument('--full', action='store_true', help='also check files that passed before and are unchanged')
+    parser.add_argument('--download', action='store_true', help='download the requeued files right away')
+    args = parser.parse_args()
+    try:
+        verify_results = verify(args.roots, args.workers, args.full)
+    finally:
+        write_summary('verify')
+
+    if args.download and verify_results['requeued']:
+        exit(work(1))